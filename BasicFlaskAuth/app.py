@@ -1,8 +1,7 @@
 from flask import Flask, request, abort
-import json
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from jwks import JWKSKeyStore
 
 
 app = Flask(__name__)
@@ -11,6 +10,8 @@ AUTH0_DOMAIN = "username.auth0.com"
 ALGORITHMS = ['RS256']
 API_AUDIENCE = "http://localhost:5000"
 
+jwks_store = JWKSKeyStore(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -52,8 +53,6 @@ def get_token_auth_header():
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -62,15 +61,21 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    try:
+        key = jwks_store.get_key(unverified_header['kid'])
+    except (OSError, ValueError):
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -111,7 +116,10 @@ def requires_auth(f):
         token = get_token_auth_header()
         try:
             payload = verify_decode_jwt(token)
-        except:
+        except AuthError as e:
+            # an unreachable identity provider says nothing about the token
+            abort(503 if e.status_code == 503 else 401)
+        except Exception:
             abort(401)
         return f(payload, *args, **kwargs)
 
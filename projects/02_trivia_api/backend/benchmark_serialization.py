@@ -0,0 +1,64 @@
+"""
+benchmark the serialization of a question list
+
+compares building the response from ORM objects via Question.format()
+with the row-tuple fast path, each encoded with the standard library
+json module and with orjson (if installed).
+the questions are inserted into a temporary SQLite database.
+
+usage:
+    python benchmark_serialization.py [--questions N] [--repeat N]
+"""
+import argparse
+import os
+import tempfile
+import timeit
+
+from flaskr import create_app, QUESTION_COLUMNS
+from flaskr.serialization import BACKENDS, query_rows
+from models import db, Question, Category
+
+
+def orm_dicts():
+    return [q.format() for q in Question.query.all()]
+
+
+def row_dicts():
+    return query_rows(Question.query, *QUESTION_COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    app = create_app({'DATABASE_PATH': f'sqlite:///{path}'})
+    try:
+        with app.app_context():
+            category = Category(type='Science')
+            category.insert()
+            Question.insert_many([
+                Question(question=f'Question number {i}?',
+                         answer=f'Answer {i}',
+                         category=category.id,
+                         difficulty=i % 5 + 1)
+                for i in range(args.questions)])
+
+            print(f'{args.questions} questions, best of {args.repeat} runs')
+            for rows_name, rows in (('orm', orm_dicts), ('rows', row_dicts)):
+                for backend, dumps in BACKENDS.items():
+                    def run():
+                        dumps({'success': True, 'questions': rows()})
+                        db.session.expire_all()
+                    best = min(timeit.repeat(run, number=1,
+                                             repeat=args.repeat))
+                    print(f'{rows_name:>5} + {backend:<7} {best * 1000:8.1f} ms')
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
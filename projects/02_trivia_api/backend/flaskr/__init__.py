@@ -1,28 +1,202 @@
 import os
+import json
+import time
+import hashlib
+import click
+from functools import wraps
 from flask import (
     Flask,
     request,
     abort,
     jsonify,
+    current_app,
+    make_response,
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
+from sqlalchemy.exc import SQLAlchemyError
 
-from models import setup_db, Question, Category
+from models import (
+    setup_db, database_path, db, Question, Category, TableVersion,
+    question_index)
+from .serialization import json_response, query_rows
 
 QUESTIONS_PER_PAGE = 10
+IMPORT_BATCH_SIZE = 500
+# clients and proxies may store the responses but must revalidate them
+CACHE_MAX_AGE = 0
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
 
 
-def paginate_questions(request, questions: list):
+def paginate_questions(request, query):
     """
-    paginate the question list with pre-defined page limit
+    paginate the question query with pre-defined page limit,
+    only the questions on the page are fetched, as plain rows
     """
     page = request.args.get('page', 1, type=int)
     start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    formatted_questions = [q.format() for q in questions]
-    return formatted_questions[start:end]
+    page_query = query.order_by(Question.id).offset(start).limit(
+        QUESTIONS_PER_PAGE)
+    return query_rows(page_query, *QUESTION_COLUMNS)
+
+
+def conditional(*tables):
+    """
+    decorator for read endpoints whose response only depends on the given
+    tables. the ETag is derived from the table versions, so conditional
+    GETs are answered with 304 before the endpoint runs its queries.
+    only If-None-Match is honored: Last-Modified has a resolution of whole
+    seconds, so a second write within the same second as a GET would be
+    answered with a stale 304 if If-Modified-Since was.
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions, last_modified = TableVersion.current(*tables)
+            etag = hashlib.sha1(
+                f'{request.full_path}|{versions}'.encode()).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.public = True
+            response.cache_control.max_age = CACHE_MAX_AGE
+            response.cache_control.must_revalidate = True
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+def difficulty_band(band):
+    """
+    the difficulties within the requested {'min': .., 'max': ..} band
+    """
+    low = int(band.get('min', MIN_DIFFICULTY))
+    high = int(band.get('max', MAX_DIFFICULTY))
+    difficulties = range(max(low, MIN_DIFFICULTY), min(high, MAX_DIFFICULTY) + 1)
+    if not difficulties:
+        raise ValueError(f'empty difficulty band {low}-{high}')
+    return difficulties
+
+
+def adaptive_difficulties(band, score, answered: int):
+    """
+    the difficulties of the band, ordered by their distance to the target
+    difficulty. the target follows the share of correct answers of the
+    player, starting in the middle of the band.
+    """
+    accuracy = min(max(score / answered, 0), 1) if answered else 0.5
+    target = band[0] + accuracy * (band[-1] - band[0])
+    return sorted(band, key=lambda difficulty: (abs(difficulty - target),
+                                                difficulty))
+
+
+def normalize_question(text: str):
+    """
+    normalize the question text to detect duplicates,
+    ignoring case, whitespace and trailing punctuation
+    """
+    return ' '.join(text.casefold().split()).rstrip('?!. ')
+
+
+def import_questions(lines, batch_size: int = IMPORT_BATCH_SIZE):
+    """
+    import questions from JSON lines, one question object per line.
+    valid questions are inserted in batched transactions, questions whose
+    normalized text already exists are skipped.
+    the import stops at the first batch the database rejects: that batch
+    is rolled back, the batches before it stay committed.
+    returns a report with the counts and the throughput, and the lines
+    of the rejected batch in failed_batch (None if every batch was
+    inserted)
+    """
+    start_time = time.perf_counter()
+    category_ids = {cat_id for (cat_id,) in
+                    Category.query.with_entities(Category.id).all()}
+    known_questions = {
+        normalize_question(text) for (text,) in
+        Question.query.with_entities(Question.question).all() if text}
+
+    inserted = duplicates = 0
+    invalid_lines = []
+    batch = []
+    batch_lines = []
+    failed_batch = None
+
+    def insert_batch():
+        """
+        Returns:
+            the report of the batch if the database rejected it, else None
+        """
+        try:
+            Question.insert_many(batch)
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            return {
+                'first_line': batch_lines[0],
+                'last_line': batch_lines[-1],
+                'error': type(e).__name__,
+            }
+        return None
+
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            question = Question(
+                question=item.get('question'),
+                answer=item.get('answer'),
+                category=int(item.get('category')),
+                difficulty=int(item.get('difficulty')),
+            )
+        except (AttributeError, TypeError, ValueError):
+            invalid_lines.append(line_number)
+            continue
+        if not question.is_valid() or question.category not in category_ids:
+            invalid_lines.append(line_number)
+            continue
+
+        key = normalize_question(question.question)
+        if key in known_questions:
+            duplicates += 1
+            continue
+        known_questions.add(key)
+
+        batch.append(question)
+        batch_lines.append(line_number)
+        if len(batch) >= batch_size:
+            failed_batch = insert_batch()
+            if failed_batch:
+                break
+            inserted += len(batch)
+            batch = []
+            batch_lines = []
+    else:
+        if batch:
+            failed_batch = insert_batch()
+            if not failed_batch:
+                inserted += len(batch)
+
+    elapsed = time.perf_counter() - start_time
+    return {
+        'inserted': inserted,
+        'duplicates': duplicates,
+        'invalid_lines': invalid_lines,
+        'failed_batch': failed_batch,
+        'seconds': round(elapsed, 3),
+        'questions_per_second': round(inserted / elapsed, 1) if elapsed else None,
+    }
 
 
 def create_app(test_config=None):
@@ -30,7 +204,9 @@ def create_app(test_config=None):
     create and configure the app
     """
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get('DATABASE_PATH', database_path))
 
     # Set up CORS. Allow "*" for origins.
     CORS(app)
@@ -48,6 +224,7 @@ def create_app(test_config=None):
         return response
 
     @app.route("/categories", methods=['GET'])
+    @conditional('categories', 'questions')
     def get_categories():
         """
         endpoint to handle GET requests
@@ -57,14 +234,18 @@ def create_app(test_config=None):
         formatted_categories = {cat.id: cat.type for cat in categories}
 
         if len(formatted_categories):
+            counts = Category.question_counts()
             return jsonify({
                 'success': True,
                 'categories': formatted_categories,
+                'questions_count': {cat.id: counts.get(cat.id, 0)
+                                    for cat in categories},
             })
         else:
             abort(404)
 
     @app.route("/questions", methods=['GET'])
+    @conditional('questions', 'categories')
     def get_questions():
         """
         Create an endpoint to handle GET requests for questions,
@@ -78,17 +259,17 @@ def create_app(test_config=None):
         Clicking on the page numbers should update the questions.
         """
         page = request.args.get('page', 1, type=int)
-        questions = Question.query.all()
+        total_questions = Question.query.count()
 
-        if len(questions) == 0 or page > len(questions)//QUESTIONS_PER_PAGE + 1:
+        if total_questions == 0 or page > total_questions//QUESTIONS_PER_PAGE + 1:
             abort(404)
         else:
-            questions_onsite = paginate_questions(request, questions)
+            questions_onsite = paginate_questions(request, Question.query)
             categories = {cat.id: cat.type for cat in Category.query.all()}
-            return jsonify({
+            return json_response({
                 'success': True,
                 'questions': questions_onsite,
-                'total_questions': len(questions),
+                'total_questions': total_questions,
                 'current_category': None,
                 'categories': categories,
             })
@@ -123,10 +304,14 @@ def create_app(test_config=None):
         of the questions list in the "List" tab.
         """
         body = request.get_json()
+        try:
+            category = int(body.get('category'))
+        except (TypeError, ValueError):
+            abort(422)
         question = Question(
             question=body.get('question'),
             answer=body.get('answer'),
-            category=body.get('category'),
+            category=category,
             difficulty=body.get('difficulty'),
         )
         if not question.is_valid():
@@ -139,6 +324,58 @@ def create_app(test_config=None):
         except BaseException as e:
             abort(422)
 
+    @app.route('/questions/import', methods=['POST'])
+    def import_questions_bulk():
+        """
+        Create an endpoint to POST many questions at once.
+        The request body is JSON lines, one question object per line,
+        in the same format as POST /questions.
+        Questions are inserted in batched transactions and
+        duplicates of existing questions are skipped.
+        If the database rejects a batch, the response is a 422 error
+        with the report of the batches inserted before it.
+        """
+        lines = request.get_data(as_text=True).splitlines()
+        if not any(line.strip() for line in lines):
+            abort(400)
+        batch_size = request.args.get('batch_size', IMPORT_BATCH_SIZE, type=int)
+        if batch_size < 1:
+            abort(400)
+        try:
+            report = import_questions(lines, batch_size)
+        except BaseException:
+            db.session.rollback()
+            abort(422)
+        if report['failed_batch']:
+            report.update(success=False, error=422,
+                          message='unprocessable entity')
+            return jsonify(report), 422
+        report['success'] = True
+        return jsonify(report)
+
+    @app.cli.command('import-questions')
+    @click.argument('path', type=click.File('r'))
+    @click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True,
+                  help='number of questions inserted per transaction')
+    def import_questions_command(path, batch_size):
+        """
+        import questions from a JSON lines file
+        """
+        report = import_questions(path, batch_size)
+        click.echo(f"inserted {report['inserted']} questions "
+                   f"in {report['seconds']}s "
+                   f"({report['questions_per_second']} questions/s), "
+                   f"skipped {report['duplicates']} duplicates")
+        if report['invalid_lines']:
+            click.echo('invalid lines: ' +
+                       ', '.join(map(str, report['invalid_lines'])))
+        failed_batch = report['failed_batch']
+        if failed_batch:
+            raise click.ClickException(
+                f"the batch of lines {failed_batch['first_line']}-"
+                f"{failed_batch['last_line']} was rolled back "
+                f"({failed_batch['error']}), the import stopped there")
+
     @app.route('/questions/search', methods=['POST'])
     def search_questions():
         """ 
@@ -153,15 +390,16 @@ def create_app(test_config=None):
         try:
             search_term = request.get_json().get('searchTerm')
             questions = Question.query.filter(
-                Question.question.ilike(f"%{search_term}%")).all()
-            if not len(questions):
+                Question.question.ilike(f"%{search_term}%"))
+            found_questions = questions.count()
+            if not found_questions:
                 abort(404)
             questions_onsite = paginate_questions(request, questions)
             categories = {cat.id: cat.type for cat in Category.query.all()}
-            return jsonify({
+            return json_response({
                 'success': True,
                 'questions': questions_onsite,
-                'found_questions': len(questions),
+                'found_questions': found_questions,
                 'current_category': None,
                 'categories': categories,
             })
@@ -179,12 +417,11 @@ def create_app(test_config=None):
         """
         categories = {cat.id: cat.type for cat in Category.query.all()}
         if category_id == 0:
-            questions = Question.query.all()
-            questions_onsite = paginate_questions(request, questions)
-            return jsonify({
+            questions_onsite = paginate_questions(request, Question.query)
+            return json_response({
                 'success': True,
                 'questions': questions_onsite,
-                'found_questions': len(questions),
+                'found_questions': Question.query.count(),
                 'current_category': category_id,
                 'categories': categories,
             })
@@ -193,15 +430,15 @@ def create_app(test_config=None):
         cat_list = [cat for (cat,) in cat_ids]
         if category_id not in cat_list:
             abort(400)
-        questions_in_cat = Question.query.filter_by(
-            category=category_id).all()
-        if not len(questions_in_cat):
+        questions_in_cat = Question.query.filter_by(category=category_id)
+        found_questions = questions_in_cat.count()
+        if not found_questions:
             abort(404)
         questions_onsite = paginate_questions(request, questions_in_cat)
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': questions_onsite,
-            'found_questions': len(questions_in_cat),
+            'found_questions': found_questions,
             'current_category': category_id,
             'categories': categories,
         })
@@ -219,26 +456,43 @@ def create_app(test_config=None):
         and shown whether they were correct or not.
         """
         body = request.get_json()
-        quiz_cat_id = body.get('quiz_category').get('id')
-        previous_qustions = body.get('previous_questions')
-
-        # given a specific category
-        if quiz_cat_id:
-            questions = Question.query.filter_by(category=quiz_cat_id).filter(
-                Question.id.notin_(previous_qustions)).all()
-        # set all categories
-        else:
-            questions = Question.query.filter(
-                Question.id.notin_(previous_qustions)).all()
-        if not questions:
-            abort(404)
-        quiz_question = random.sample(questions, 1)[0].format()
-        return jsonify({
-            'success': True,
-            'question': quiz_question,
-        })
+        try:
+            quiz_cat_id = int(body.get('quiz_category').get('id'))
+            previous_questions = [int(question_id) for question_id
+                                  in body.get('previous_questions') or []]
+            band = body.get('difficulty')
+            difficulties = difficulty_band(band) if band else None
+            if body.get('adaptive'):
+                difficulties = difficulties or difficulty_band({})
+                # draw from the closest difficulty which has questions left
+                draws = [{difficulty} for difficulty in adaptive_difficulties(
+                    difficulties, float(body.get('score', 0)),
+                    len(previous_questions))]
+            else:
+                draws = [set(difficulties) if difficulties else None]
+        except (AttributeError, TypeError, ValueError):
+            abort(400)
+
+        # category 0 stands for all categories
+        category = quiz_cat_id or None
+        for draw in draws:
+            question_id = question_index.draw(
+                category, draw, exclude=previous_questions)
+            while question_id is not None:
+                question = Question.query.get(question_id)
+                if question is not None:
+                    return jsonify({
+                        'success': True,
+                        'question': question.format(),
+                    })
+                # deleted by another process since the index was built
+                question_index.discard(question_id)
+                question_id = question_index.draw(
+                    category, draw, exclude=previous_questions)
+        abort(404)
 
     @app.route('/questions/<int:question_id>', methods=['GET'])
+    @conditional('questions')
     def get_question_with_id(question_id):
         question = Question.query.filter(
             Question.id == question_id).one_or_none()
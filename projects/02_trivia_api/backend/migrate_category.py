@@ -0,0 +1,139 @@
+"""
+migrate questions.category to an indexed integer foreign key on categories.id
+
+databases created from an older version of models.py store the category
+as a string. this script converts the column in place, backfilling the
+integer values in batches of question ids so that no single transaction
+locks the whole table, then adds the foreign key and the index.
+databases that already have an integer column only get the missing
+constraint and index.
+
+categories which are not numbers are listed and nothing is changed,
+unless --null-invalid is given, which stores them as NULL. the script
+can be run again after a failure, it continues with the existing
+category_id column.
+
+usage:
+    python migrate_category.py [--database-path URI] [--batch-size N]
+                               [--null-invalid]
+"""
+import argparse
+import sys
+from sqlalchemy import create_engine, inspect, text, Integer
+
+from models import database_path
+
+BATCH_SIZE = 1000
+INDEX_NAME = 'ix_questions_category'
+FOREIGN_KEY_NAME = 'category'
+NUMERIC_CATEGORY = "TRIM(category) ~ '^[0-9]+$'"
+
+
+def category_column(engine):
+    """
+    reflected definition of questions.category
+    """
+    columns = inspect(engine).get_columns('questions')
+    return next(col for col in columns if col['name'] == 'category')
+
+
+def invalid_categories(engine):
+    """
+    the (id, category) of the questions whose string category is not a
+    number, and would become NULL
+    """
+    with engine.connect() as conn:
+        return conn.execute(text(
+            'SELECT id, category FROM questions '
+            f'WHERE category IS NOT NULL AND NOT {NUMERIC_CATEGORY} '
+            'ORDER BY id')).fetchall()
+
+
+def backfill_category(engine, batch_size):
+    """
+    copy the string category into a new integer column, batch by batch,
+    then swap the new column in place of the old one. a category_id
+    column left by an earlier run is reused
+    """
+    columns = {col['name'] for col in
+               inspect(engine).get_columns('questions')}
+    with engine.begin() as conn:
+        if 'category_id' not in columns:
+            conn.execute(text(
+                'ALTER TABLE questions ADD COLUMN category_id INTEGER'))
+        (max_id,) = conn.execute(text(
+            'SELECT COALESCE(MAX(id), 0) FROM questions')).first()
+
+    converted = 0
+    for lower in range(0, max_id, batch_size):
+        with engine.begin() as conn:
+            result = conn.execute(text(
+                "UPDATE questions "
+                "SET category_id = CAST(TRIM(category) AS INTEGER) "
+                "WHERE id > :lower AND id <= :upper "
+                f"AND {NUMERIC_CATEGORY}"),
+                lower=lower, upper=lower + batch_size)
+        converted += result.rowcount
+        print(f'converted {converted} questions (up to id {lower + batch_size})')
+
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE questions DROP COLUMN category'))
+        conn.execute(text(
+            'ALTER TABLE questions RENAME COLUMN category_id TO category'))
+
+
+def add_constraints(engine):
+    """
+    add the foreign key and the index if they are not there yet
+    """
+    inspector = inspect(engine)
+    foreign_keys = inspector.get_foreign_keys('questions')
+    indexes = inspector.get_indexes('questions')
+
+    with engine.begin() as conn:
+        if not any(fk['constrained_columns'] == ['category']
+                   for fk in foreign_keys):
+            # orphaned ids would make the constraint fail
+            orphaned = conn.execute(text(
+                'UPDATE questions SET category = NULL '
+                'WHERE category NOT IN (SELECT id FROM categories)')).rowcount
+            if orphaned:
+                print(f'set the unknown category of {orphaned} questions '
+                      'to NULL')
+            conn.execute(text(
+                f'ALTER TABLE questions ADD CONSTRAINT {FOREIGN_KEY_NAME} '
+                'FOREIGN KEY (category) REFERENCES categories (id) '
+                'ON UPDATE CASCADE ON DELETE SET NULL'))
+            print('added foreign key questions.category -> categories.id')
+        if not any(idx['column_names'] == ['category'] for idx in indexes):
+            conn.execute(text(
+                f'CREATE INDEX {INDEX_NAME} ON questions (category)'))
+            print(f'added index {INDEX_NAME}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database-path', default=database_path)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--null-invalid', action='store_true',
+                        help='store categories which are not numbers '
+                             'as NULL instead of stopping')
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_path)
+    if not isinstance(category_column(engine)['type'], Integer):
+        invalid = invalid_categories(engine)
+        for question_id, category in invalid:
+            print(f'question {question_id}: category {category!r} '
+                  'is not a number')
+        if invalid and not args.null_invalid:
+            sys.exit(f'{len(invalid)} categories are not numbers, fix them '
+                     'or run again with --null-invalid to store them as NULL')
+        if invalid:
+            print(f'storing {len(invalid)} invalid categories as NULL')
+        backfill_category(engine, args.batch_size)
+    add_constraints(engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,13 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import time
+import random
+import bisect
+import itertools
+import threading
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import (
+    Column, String, Integer, DateTime, ForeignKey, create_engine, func)
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -19,6 +27,7 @@ def setup_db(app, database_path=database_path):
     db.app = app
     db.init_app(app)
     db.create_all()
+    TableVersion.ensure('questions', 'categories')
 
 
 class Question(db.Model):
@@ -30,7 +39,8 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE',
+                                          ondelete='SET NULL'), index=True)
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -41,14 +51,32 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
+        question_index.add(self)
+
+    @staticmethod
+    def insert_many(questions):
+        """
+        inserts a batch of questions in a single transaction
+        """
+        db.session.add_all(questions)
+        TableVersion.bump(Question.__tablename__)
+        db.session.commit()
+        for question in questions:
+            question_index.add(question)
 
     def update(self):
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
+        question_index.add(self)
 
     def delete(self):
+        question_id = self.id
         db.session.delete(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
+        question_index.discard(question_id)
 
     def format(self):
         return {
@@ -85,10 +113,195 @@ class Category(db.Model):
             'type': self.type
         }
 
+    @staticmethod
+    def question_counts():
+        """
+        number of questions per category id, in a single grouped query
+        """
+        counts = db.session.query(Question.category, func.count(Question.id)) \
+            .group_by(Question.category).all()
+        return {category_id: count for (category_id, count) in counts}
+
     def insert(self):
         db.session.add(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
\ No newline at end of file
+        TableVersion.bump(self.__tablename__)
+        db.session.commit()
+
+
+class TableVersion(db.Model):
+    """
+    TableVersion
+    a version counter per table, bumped in the same transaction as
+    every write to the table. used to build ETags for read endpoints
+    without querying the tables themselves.
+    """
+    __tablename__ = 'table_versions'
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
+        self.updated_at = datetime.utcnow()
+
+    @staticmethod
+    def ensure(*names):
+        """
+        creates the missing counters
+        """
+        existing = {name for (name,) in TableVersion.query.with_entities(
+            TableVersion.name).filter(TableVersion.name.in_(names)).all()}
+        missing = [TableVersion(name) for name in names if name not in existing]
+        if missing:
+            db.session.add_all(missing)
+            db.session.commit()
+
+    @staticmethod
+    def bump(name):
+        """
+        increments the counter of the table in the current transaction
+        """
+        updated = TableVersion.query.filter_by(name=name).update({
+            'version': TableVersion.version + 1,
+            'updated_at': datetime.utcnow(),
+        }, synchronize_session=False)
+        if not updated:
+            db.session.add(TableVersion(name, version=1))
+
+    @staticmethod
+    def current(*names):
+        """
+        the versions of the given tables and the time of the latest write
+        """
+        rows = TableVersion.query.filter(TableVersion.name.in_(names)).all()
+        versions = {row.name: row.version for row in rows}
+        last_modified = max((row.updated_at for row in rows), default=None)
+        return tuple(versions.get(name, 0) for name in names), last_modified
+
+
+class QuestionIndex:
+    """
+    QuestionIndex
+    the question ids of each (category, difficulty) bucket, kept sorted
+    in memory so that quiz questions are drawn without querying the
+    questions table. the index is built on first use, updated by
+    Question insert/update/delete, and rebuilt after max_age seconds to
+    pick up the writes of other processes.
+    the buckets matching a draw and their cumulative sizes are kept per
+    (category, difficulties) until the next change, so a draw bisects
+    into them instead of walking every bucket.
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._buckets = None
+        self._keys = {}
+        self._selections = {}
+        self._built_at = 0
+
+    def _build(self):
+        buckets = defaultdict(list)
+        keys = {}
+        rows = Question.query.with_entities(
+            Question.id, Question.category, Question.difficulty) \
+            .order_by(Question.id).all()
+        for (question_id, category, difficulty) in rows:
+            buckets[(category, difficulty)].append(question_id)
+            keys[question_id] = (category, difficulty)
+        self._buckets, self._keys = buckets, keys
+        self._selections = {}
+        self._built_at = time.monotonic()
+
+    def _ensure_built(self):
+        if (self._buckets is None
+                or time.monotonic() - self._built_at > self.max_age):
+            self._build()
+
+    def _select(self, category, difficulties):
+        """
+        the non-empty buckets of the category and difficulties and their
+        cumulative sizes
+        """
+        key = (category, None if difficulties is None
+               else frozenset(difficulties))
+        selection = self._selections.get(key)
+        if selection is None:
+            buckets = [ids for ((cat, difficulty), ids) in self._buckets.items()
+                       if ids and (category is None or cat == category)
+                       and (difficulties is None or difficulty in difficulties)]
+            selection = (buckets, list(itertools.accumulate(map(len, buckets))))
+            self._selections[key] = selection
+        return selection
+
+    def _remove(self, question_id):
+        key = self._keys.pop(question_id, None)
+        if key is not None:
+            self._selections = {}
+            bucket = self._buckets[key]
+            position = bisect.bisect_left(bucket, question_id)
+            if position < len(bucket) and bucket[position] == question_id:
+                del bucket[position]
+
+    def add(self, question):
+        """
+        (re-)indexes the question under its current category and difficulty
+        """
+        with self._lock:
+            if self._buckets is None:
+                return
+            self._remove(question.id)
+            key = (question.category, question.difficulty)
+            bisect.insort(self._buckets[key], question.id)
+            self._keys[question.id] = key
+            self._selections = {}
+
+    def discard(self, question_id):
+        with self._lock:
+            if self._buckets is not None:
+                self._remove(question_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._buckets = None
+
+    def draw(self, category=None, difficulties=None, exclude=()):
+        """
+        a random question id of the given category (all if None) and
+        difficulties (all if None), which is not in exclude.
+        returns None if there is no such question
+        """
+        exclude = set(exclude)
+        with self._lock:
+            self._ensure_built()
+            buckets, sizes = self._select(category, difficulties)
+            total = sizes[-1] if sizes else 0
+            if total <= len(exclude):
+                # cheap check only, the excluded ids may be in other buckets
+                candidates = [question_id for ids in buckets
+                              for question_id in ids
+                              if question_id not in exclude]
+                return random.choice(candidates) if candidates else None
+
+            # rejection sampling, the previous questions are usually few
+            for _ in range(8):
+                position = random.randrange(total)
+                bucket = bisect.bisect_right(sizes, position)
+                if bucket:
+                    position -= sizes[bucket - 1]
+                question_id = buckets[bucket][position]
+                if question_id not in exclude:
+                    return question_id
+
+            candidates = [question_id for ids in buckets for question_id in ids
+                          if question_id not in exclude]
+            return random.choice(candidates) if candidates else None
+
+
+question_index = QuestionIndex()
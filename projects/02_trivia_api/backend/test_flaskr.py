@@ -1,10 +1,12 @@
 import os
 import unittest
 import json
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 
 from flaskr import create_app, QUESTIONS_PER_PAGE
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -68,6 +70,15 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(len(data['categories']), 6)
 
+    def test_get_categories_questions_count(self):
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions_count']), 6)
+        self.assertEqual(data['questions_count']['1'], 3)
+        self.assertEqual(sum(data['questions_count'].values()), 19)
+
     def test_get_paginated_questions(self):
         res = self.client().get('/questions?page=2')
         data = json.loads(res.data)
@@ -79,6 +90,36 @@ class TriviaTestCase(unittest.TestCase):
         self.assertIsNone(data['current_category'])
         self.assertEqual(len(data['categories']), 6)
 
+    def test_304_get_questions_not_modified(self):
+        res = self.client().get('/questions?page=1')
+        etag = res.headers['ETag']
+        res = self.client().get('/questions?page=1',
+                                headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertIn('must-revalidate', res.headers['Cache-Control'])
+
+    def test_if_modified_since_is_not_answered_with_304(self):
+        res = self.client().get('/questions?page=1')
+        res = self.client().get('/questions?page=1', headers={
+            'If-Modified-Since': res.headers['Last-Modified']})
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_etag_changes_after_question_insert(self):
+        res = self.client().get('/questions?page=1')
+        etag = res.headers['ETag']
+        question = Question(**self.valid_question)
+        question.insert()
+        res = self.client().get('/questions?page=1',
+                                headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        question.delete()
+
     def test_404_sent_requsting_beyond_valid_page(self):
         res = self.client().get('/questions?page=100')
         data = json.loads(res.data)
@@ -116,6 +157,65 @@ class TriviaTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], 'unprocessable entity')
 
+    def test_import_questions(self):
+        lines = '\n'.join([
+            json.dumps(self.valid_question),
+            json.dumps(self.valid_question),
+            json.dumps(self.invalid_question),
+        ])
+        res = self.client().post('/questions/import', data=lines,
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['duplicates'], 1)
+        self.assertEqual(data['invalid_lines'], [3])
+
+        # delete the record after execution
+        Question.query.filter_by(
+            question=self.valid_question['question']).delete()
+        db.session.commit()
+
+    def test_422_import_reports_committed_batches(self):
+        questions = [dict(self.valid_question, question=f'Import {i}?')
+                     for i in range(3)]
+        lines = '\n'.join(map(json.dumps, questions))
+        insert_many = Question.insert_many
+
+        def fail_second_batch(batch):
+            if batch[0].question == questions[1]['question']:
+                raise IntegrityError('INSERT', {}, Exception())
+            insert_many(batch)
+
+        with mock.patch.object(Question, 'insert_many', fail_second_batch):
+            res = self.client().post('/questions/import?batch_size=1',
+                                     data=lines,
+                                     content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['failed_batch'], {
+            'first_line': 2, 'last_line': 2, 'error': 'IntegrityError'})
+
+        # delete the records after execution
+        Question.query.filter(Question.question.in_(
+            [q['question'] for q in questions])).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+    def test_400_import_empty_body(self):
+        res = self.client().post('/questions/import', data='',
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'bad request')
+
     def test_delete_question(self):
         # insert a new record before execution
         question = Question(
@@ -213,6 +313,36 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(
             data['question']['id'], self.quiz_info_specific_category['quiz_category']['id'])
 
+    def test_post_quiz_difficulty_band(self):
+        quiz_info = dict(self.quiz_info_all_categories,
+                         difficulty={'min': 4, 'max': 5})
+        res = self.client().post('/quizzes', json=quiz_info)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn(data['question']['difficulty'], [4, 5])
+
+    def test_post_quiz_adaptive(self):
+        quiz_info = dict(self.quiz_info_all_categories,
+                         adaptive=True, score=0, previous_questions=[5, 9])
+        res = self.client().post('/quizzes', json=quiz_info)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['question']['difficulty'], 1)
+
+    def test_400_post_quiz_invalid_difficulty_band(self):
+        quiz_info = dict(self.quiz_info_all_categories,
+                         difficulty={'min': 6, 'max': 10})
+        res = self.client().post('/quizzes', json=quiz_info)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'bad request')
+
     def test_404_post_quiz_no_questions_left(self):
         quiz_info = self.quiz_info_all_categories
         question_ids = Question.query.with_entities(Question.id).all()
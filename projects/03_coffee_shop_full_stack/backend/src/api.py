@@ -1,40 +1,113 @@
 import os
+import click
 from flask import Flask, request, jsonify, abort
 from sqlalchemy import exc
-import json
 from flask_cors import CORS
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
-from .auth.auth import AuthError, requires_auth
+from .database.models import (
+    db, db_create_all, db_drop_and_create_all, setup_db, Drink)
+from .auth.auth import (
+    AuthError, check_permissions, current_permissions, requires_auth)
+from .menu_cache import MenuCache
 
 app = Flask(__name__)
 setup_db(app)
 CORS(app)
 
-"""
-initialize the datbase
-!! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
-!! NOTE THIS MUST BE UNCOMMENTED ON FIRST RUN
-"""
-db_drop_and_create_all()
+# seconds after which a worker rebuilds the menu to see other workers' writes
+menu_cache = MenuCache(max_age=int(os.environ.get('MENU_CACHE_MAX_AGE', 30)))
+
+# the permission required by each operation of POST /drinks/batch
+BATCH_PERMISSIONS = {
+    'create': 'post:drinks',
+    'update': 'patch:drinks',
+    'delete': 'delete:drinks',
+}
+MAX_BATCH_SIZE = 200
+
+
+@app.cli.command('init-db')
+@click.option('--drop', is_flag=True,
+              help='Drop all tables first. THIS DELETES ALL RECORDS.')
+def init_db_command(drop):
+    """
+    initialize the database, run once before starting the server and
+    after upgrading, it creates the missing tables and applies the
+    upgrades of db_upgrade() to existing ones, including moving the json
+    recipes of the first release into ingredient rows
+    """
+    if drop:
+        db_drop_and_create_all()
+        click.echo('Dropped and recreated all tables.')
+        return
+    try:
+        upgrades = db_create_all()
+    except ValueError as e:
+        raise click.ClickException(
+            f'{e}, the database was not upgraded. Fix the recipe or run '
+            '"flask init-db --drop", which deletes all records.')
+    click.echo('Created the missing tables.')
+    for upgrade in upgrades:
+        click.echo(f'Upgraded: {upgrade}.')
+
 
 # ROUTES
 
 
+def parse_recipe(recipe):
+    """
+    the recipe of a request as a list of ingredients,
+    a single ingredient may be sent as a dictionary
+    """
+    if isinstance(recipe, dict):
+        return [recipe]
+    return recipe
+
+
+def menu_response(detail=False):
+    """
+    the cached menu, or 304 if the client has the current version
+    """
+    menu = menu_cache.get(detail)
+    response = app.response_class(menu.body, mimetype='application/json')
+    response.set_etag(menu.etag)
+    response.cache_control.no_cache = True
+    if detail:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response.make_conditional(request)
+
+
 @app.route('/drinks', methods=['GET'])
 def get_drinks():
     """
     public endpoint GET /drinks
     contains only the drink.short() data representation
+    served from the menu cache, honors If-None-Match with 304
+    optional query parameters, answered from the database indexes:
+        ingredient: only drinks containing the ingredient, may be repeated
+            to require several ingredients, case and spacing are ignored
+        max_parts: only drinks with at most this number of parts in total
     Returns:
         status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         appropriate status code indicating reason for failure
     """
+    ingredients = request.args.getlist('ingredient')
+    max_parts = request.args.get('max_parts')
+    if max_parts is not None:
+        try:
+            max_parts = int(max_parts)
+        except ValueError:
+            abort(400)
+
     try:
-        drinks = [drink.short() for drink in Drink.query.all()]
+        if not ingredients and max_parts is None:
+            return menu_response()
+        drinks = Drink.search(ingredients, max_parts).all()
         return jsonify({
             'success': True,
-            'drinks': drinks,
+            'drinks': [drink.short() for drink in drinks],
         })
     except:
         abort(500)
@@ -47,16 +120,13 @@ def get_drinks_detail(payload):
     endpoint GET /drinks-detail
     requires the 'get:drinks-detail' permission
     contains the drink.long() data representation
+    served from the menu cache, honors If-None-Match with 304
     Returns:
         status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         appropriate status code indicating reason for failure
     """
     try:
-        drinks = [drink.long() for drink in Drink.query.all()]
-        return jsonify({
-            'success': True,
-            'drinks': drinks,
-        })
+        return menu_response(detail=True)
     except:
         abort(500)
 
@@ -75,12 +145,13 @@ def post_drink(payload):
     """
     body = request.get_json()
 
-    drink = Drink(
-        title=body.get('title'),
-        recipe=json.dumps(body.get('recipe')),
-    )
     try:
+        drink = Drink(
+            title=body.get('title'),
+            recipe=parse_recipe(body.get('recipe')),
+        )
         drink.insert()
+        menu_cache.refresh()
         return jsonify({
             'success': True,
             'drinks': [drink.long()],
@@ -109,8 +180,9 @@ def patch_drink(payload, id):
             if 'title' in body:
                 drink.title = body.get('title')
             if 'recipe' in body:
-                drink.recipe = json.dumps(body.get('recipe'))
+                drink.recipe = parse_recipe(body.get('recipe'))
             drink.update()
+            menu_cache.refresh()
             return jsonify({
                 'success': True,
                 'drinks': [drink.long()],
@@ -137,6 +209,7 @@ def delete_drink(payload, id):
         drink = Drink.query.filter_by(id=id).one_or_none()
         if drink:
             drink.delete()
+            menu_cache.refresh()
             return jsonify({
                 'success': True,
                 'delete': id,
@@ -147,6 +220,131 @@ def delete_drink(payload, id):
         abort(500)
 
 
+class DrinkNotFound(Exception):
+    """
+    DrinkNotFound Exception
+    raised by a batch operation on a drink which does not exist
+    """
+
+
+def apply_operation(operation):
+    """
+    applies one operation of a batch to the session and flushes it,
+    without committing
+    Raises:
+        DrinkNotFound: if the drink to update or delete does not exist
+        KeyError, TypeError, ValueError: if the recipe is malformed
+        sqlalchemy.exc.SQLAlchemyError: if the database rejects the change
+    Returns:
+        the result of the operation
+    """
+    kind = operation['op']
+    if kind == 'create':
+        drink = Drink(
+            title=operation.get('title'),
+            recipe=parse_recipe(operation.get('recipe')),
+        )
+        db.session.add(drink)
+        db.session.flush()
+        return {'status': 'created', 'drink': drink.long()}
+
+    drink = Drink.query.get(int(operation.get('id')))
+    if drink is None:
+        raise DrinkNotFound()
+    if kind == 'delete':
+        db.session.delete(drink)
+        db.session.flush()
+        return {'status': 'deleted', 'delete': drink.id}
+
+    if 'title' in operation:
+        drink.title = operation.get('title')
+    if 'recipe' in operation:
+        drink.recipe = parse_recipe(operation.get('recipe'))
+    db.session.flush()
+    return {'status': 'updated', 'drink': drink.long()}
+
+
+@app.route('/drinks/batch', methods=['POST'])
+@requires_auth()
+def batch_drinks(payload):
+    """
+    endpoint POST /drinks/batch
+    applies a list of operations to the menu in a single transaction
+        {"operations": [
+            {"op": "create", "title": ..., "recipe": ...},
+            {"op": "update", "id": ..., "title": ..., "recipe": ...},
+            {"op": "delete", "id": ...}]}
+    requires 'post:drinks', 'patch:drinks' and 'delete:drinks' for the
+    kinds of operations in the batch, checked once before applying them
+    all operations are committed together, if one of them fails none
+    is committed, the operations before it are rolled back and the
+    operations after it are skipped
+    Returns:
+        status code 200 and json {"success": True, "results": results} where results has one entry per operation
+        status code 422 and json {"success": False, "results": results} where the failed operation has an "error"
+        appropriate status code indicating reason for failure
+    """
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list) or \
+            not 0 < len(operations) <= MAX_BATCH_SIZE or \
+            any(not isinstance(operation, dict) or
+                operation.get('op') not in BATCH_PERMISSIONS
+                for operation in operations):
+        abort(400)
+    check_permissions(sorted({BATCH_PERMISSIONS[operation['op']]
+                              for operation in operations}),
+                      current_permissions())
+
+    results = []
+    failed = False
+    for index, operation in enumerate(operations):
+        result = {'index': index, 'op': operation['op']}
+        results.append(result)
+        if failed:
+            result['status'] = 'skipped'
+            continue
+        try:
+            result.update(apply_operation(operation))
+        except DrinkNotFound:
+            result.update(status='failed', error='resource not found')
+            failed = True
+        except (KeyError, TypeError, ValueError):
+            result.update(status='failed', error='invalid drink')
+            failed = True
+        except exc.SQLAlchemyError:
+            result.update(status='failed', error='rejected by the database')
+            failed = True
+
+    if failed:
+        db.session.rollback()
+        # the operations before the failed one were rolled back with it
+        for result in results:
+            if result['status'] not in ('failed', 'skipped'):
+                results[result['index']] = {
+                    'index': result['index'],
+                    'op': result['op'],
+                    'status': 'rolled_back',
+                }
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'results': results,
+        }), 422
+
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+    menu_cache.refresh()
+    return jsonify({
+        'success': True,
+        'results': results,
+    })
+
+
 # Error Handling
 @app.errorhandler(400)
 def bad_request(error):
@@ -0,0 +1,122 @@
+"""
+JWKS key store
+
+Caches the signing keys of the identity provider by key id ('kid'),
+so that verifying a token does not download the JWKS document
+on every request.
+"""
+import json
+import re
+import threading
+import time
+from urllib.request import urlopen
+
+DEFAULT_TTL = 600
+MIN_REFRESH_INTERVAL = 30
+FETCH_TIMEOUT = 5
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class JWKSKeyStore:
+    """
+    the keys of a JWKS document, cached by kid
+        - the keys are kept for the max-age of the Cache-Control header
+          of the response, or ttl seconds if there is none
+        - expired keys are still served while a background thread
+          refreshes them, up to another ttl seconds
+        - an unknown kid refetches the document synchronously, since the
+          keys may have been rotated, at most once every
+          min_refresh_interval seconds
+        - while nothing can be served, a failed fetch is raised again
+          until the document may be refetched
+        - url may be a file:// url, e.g. a local JWKS file in tests
+    """
+
+    def __init__(self, url, ttl=DEFAULT_TTL,
+                 min_refresh_interval=MIN_REFRESH_INTERVAL,
+                 timeout=FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._expires_at = None
+        self._last_fetch = None
+        self._last_error = None
+        self._fetch_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def fetch(self):
+        """
+        downloads the JWKS document
+        Returns:
+            the keys by kid and the number of seconds they may be cached
+        """
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+            cache_control = response.headers.get('Cache-Control') or ''
+        match = MAX_AGE.search(cache_control)
+        max_age = int(match.group(1)) if match else self.ttl
+        keys = {key['kid']: key for key in jwks.get('keys', []) if 'kid' in key}
+        return keys, max(max_age, self.min_refresh_interval)
+
+    def refresh(self):
+        """
+        replaces the cached keys with the current JWKS document
+        """
+        with self._fetch_lock:
+            self._last_fetch = time.monotonic()
+            try:
+                keys, max_age = self.fetch()
+            except Exception as e:
+                self._last_error = e
+                raise
+            self._last_error = None
+            self._keys = keys
+            self._expires_at = time.monotonic() + max_age
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                # keep serving the cached keys, the next request retries
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _may_refetch(self, now):
+        return (self._last_fetch is None
+                or now - self._last_fetch >= self.min_refresh_interval)
+
+    def get_key(self, kid):
+        """
+        the JWK with the given kid, or None if the provider has no such key
+        Raises:
+            OSError, ValueError: if the JWKS document cannot be fetched and
+                no cached keys may be served
+        """
+        now = time.monotonic()
+        if self._expires_at is None or now >= self._expires_at + self.ttl:
+            # nothing cached yet, or too stale to be served
+            if self._may_refetch(now):
+                self.refresh()
+            elif self._last_error is not None:
+                raise self._last_error
+        elif now >= self._expires_at:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch(time.monotonic()):
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
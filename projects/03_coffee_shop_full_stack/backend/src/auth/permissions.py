@@ -0,0 +1,62 @@
+"""
+permission sets
+
+The permissions of a token are converted once into a frozen set. A
+required permission is looked up together with the wildcard scopes
+which grant it, so checking it does not scan the permissions of the
+token, however many it carries.
+"""
+from functools import lru_cache
+
+WILDCARD = '*'
+
+
+@lru_cache(maxsize=1024)
+def granting_scopes(permission):
+    """
+    the scopes which grant the required permission, for 'post:drinks':
+        - the permission itself and '*'
+        - one segment replaced by a wildcard: '*:drinks', 'post:*'
+        - the resource scope 'drinks:*'
+    and for deeper scopes such as 'patch:drinks:recipe' the hierarchical
+    prefixes 'patch:*' and 'patch:drinks:*'
+    """
+    parts = permission.split(':')
+    scopes = {permission, WILDCARD}
+    for i in range(len(parts)):
+        scopes.add(':'.join(parts[:i] + [WILDCARD] + parts[i + 1:]))
+        if i:
+            scopes.add(':'.join(parts[:i] + [WILDCARD]))
+    if len(parts) == 2:
+        action, resource = parts
+        scopes.add(f'{resource}:{WILDCARD}')
+    return frozenset(scopes)
+
+
+class PermissionSet:
+    """
+    the frozen permissions of a decoded token
+    """
+    __slots__ = ('permissions',)
+
+    def __init__(self, permissions):
+        self.permissions = frozenset(permissions)
+
+    @classmethod
+    def from_payload(cls, payload):
+        """
+        the permission set of the payload, or None if the payload
+        does not include permissions
+        """
+        if 'permissions' not in payload:
+            return None
+        return cls(payload['permissions'])
+
+    def allows(self, permission):
+        return not self.permissions.isdisjoint(granting_scopes(permission))
+
+    def missing(self, permissions):
+        """
+        the required permissions which are not granted
+        """
+        return [p for p in permissions if not self.allows(p)]
@@ -1,24 +1,187 @@
 import os
-from sqlalchemy import Column, String, Integer
+import sqlite3
+from sqlalchemy import (
+    Column, MetaData, String, Integer, ForeignKey, Index, distinct, event,
+    func, inspect)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship, validates
 from flask_sqlalchemy import SQLAlchemy
 import json
 
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
-database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filename))
+# DATABASE_URL selects another database, e.g. postgresql://user@host/coffee
+database_path = os.environ.get('DATABASE_URL') or \
+    "sqlite:///{}".format(os.path.join(project_dir, database_filename))
+
+# applied to every SQLite connection: WAL lets readers run concurrently
+# with a writer, busy_timeout makes a writer wait for the lock
+# instead of failing with "database is locked"
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'foreign_keys': 'ON',
+    'cache_size': -16000,
+    'mmap_size': 134217728,
+}
 
 db = SQLAlchemy()
 
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    does not create or change any table, see db_create_all()
 '''
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if not database_path.startswith('sqlite'):
+        # drop connections closed by the server instead of failing requests
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            'pool_pre_ping': True,
+            'pool_recycle': 1800,
+        }
     db.app = app
     db.init_app(app)
 
+'''
+db_create_all()
+    creates the tables which do not exist yet and upgrades the existing
+    ones, see db_upgrade(), keeps all records
+    returns the upgrades applied
+'''
+def db_create_all():
+    db.create_all()
+    return db_upgrade()
+
+'''
+db_upgrade()
+    adds the columns and indexes added to the models since a table was
+    created, which create_all() does not, and fills in their values:
+        the json drink.recipe of the first release, moved to ingredient
+        rows, see upgrade_recipes()
+        drink.total_parts and ingredient.name_key with their indexes
+    other changes of existing tables are not handled
+    returns the descriptions of the upgrades applied, empty if the tables
+    were up to date
+    raises ValueError if a json recipe is malformed, nothing is changed
+'''
+def db_upgrade():
+    upgrades = []
+    if 'recipe' in {column['name'] for column in
+                    inspect(db.engine).get_columns('drink')}:
+        upgrade_recipes()
+        upgrades.append('moved the json recipes into ingredient rows')
+
+    inspector = inspect(db.engine)
+    columns = {table: {column['name'] for column in
+                       inspector.get_columns(table)}
+               for table in ('drink', 'ingredient')}
+    indexes = {index['name'] for table in ('drink', 'ingredient')
+               for index in inspector.get_indexes(table)}
+
+    if 'total_parts' not in columns['drink']:
+        db.session.execute(
+            'ALTER TABLE drink ADD COLUMN total_parts INTEGER NOT NULL '
+            'DEFAULT 0')
+        db.session.execute(
+            'UPDATE drink SET total_parts = (SELECT COALESCE(SUM(parts), 0) '
+            'FROM ingredient WHERE ingredient.drink_id = drink.id)')
+        upgrades.append('added drink.total_parts')
+    if 'name_key' not in columns['ingredient']:
+        db.session.execute(
+            "ALTER TABLE ingredient ADD COLUMN name_key VARCHAR(80) NOT NULL "
+            "DEFAULT ''")
+        # casefold() has no SQL equivalent
+        for id, name in db.session.execute(
+                'SELECT id, name FROM ingredient').fetchall():
+            db.session.execute(
+                'UPDATE ingredient SET name_key = :key WHERE id = :id',
+                {'key': ingredient_key(name), 'id': id})
+        upgrades.append('added ingredient.name_key')
+    db.session.commit()
+
+    for table in (Drink.__table__, Ingredient.__table__):
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(db.engine)
+                upgrades.append(f'created the index {index.name}')
+    return upgrades
+
+'''
+upgrade_recipes()
+    moves the json recipes of the drink table of the first release into
+    ingredient rows and removes the drink.recipe column, in one
+    transaction. SQLite cannot drop the column, so the drink table is
+    rebuilt without it, with the foreign keys off as SQLite requires
+    raises ValueError if a recipe is not a list of ingredients
+'''
+def upgrade_recipes():
+    with db.engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            # has no effect within a transaction
+            connection.execute('PRAGMA foreign_keys=OFF')
+        try:
+            with connection.begin():
+                if sqlite:
+                    # pysqlite would run the CREATE TABLE outside of it
+                    connection.execute('BEGIN')
+                move_recipes(connection)
+                if sqlite:
+                    rebuilt = Drink.__table__.tometadata(
+                        MetaData(), name='drink_upgrade')
+                    # named after drink_upgrade, db_upgrade() adds them
+                    rebuilt.indexes.clear()
+                    rebuilt.create(connection)
+                    connection.execute(
+                        'INSERT INTO drink_upgrade (id, title, total_parts) '
+                        'SELECT id, title, (SELECT COALESCE(SUM(parts), 0) '
+                        'FROM ingredient WHERE drink_id = drink.id) '
+                        'FROM drink')
+                    connection.execute('DROP TABLE drink')
+                    connection.execute(
+                        'ALTER TABLE drink_upgrade RENAME TO drink')
+                else:
+                    connection.execute('ALTER TABLE drink DROP COLUMN recipe')
+        finally:
+            if sqlite:
+                connection.execute('PRAGMA foreign_keys=ON')
+
+
+'''
+move_recipes(connection)
+    inserts the ingredient rows of the json recipes of the drinks which
+    have none yet
+    raises ValueError if a recipe is not a list of ingredients
+'''
+def move_recipes(connection):
+    ingredients = []
+    for drink_id, recipe in connection.execute(
+            'SELECT id, recipe FROM drink WHERE id NOT IN '
+            '(SELECT drink_id FROM ingredient) ORDER BY id').fetchall():
+        try:
+            ingredients.extend(
+                {'drink_id': drink_id, 'position': position,
+                 'name': r['name'], 'name_key': ingredient_key(r['name']),
+                 'color': r['color'], 'parts': int(r['parts'])}
+                for position, r in enumerate(json.loads(recipe)))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'drink {drink_id} has a malformed recipe')
+    if ingredients:
+        connection.execute(Ingredient.__table__.insert(), ingredients)
+
+
 '''
 db_drop_and_create_all()
     drops the database tables and starts fresh
@@ -38,21 +201,60 @@ class Drink(db.Model):
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     # String Title
     title = Column(String(80), unique=True)
-    # the ingredients blob - this stores a lazy json blob
-    # the required datatype is [{'color': string, 'name':string, 'parts':number}]
-    recipe =  Column(String(180), nullable=False)
+    # the sum of the parts of the recipe, kept in sync by the recipe setter
+    total_parts = Column(Integer, nullable=False, default=0, index=True)
+    # the ingredients of the recipe, one row each, loaded together with
+    # the drinks by a single additional query
+    ingredients = relationship('Ingredient', order_by='Ingredient.position',
+                               cascade='all, delete-orphan', lazy='selectin')
+
+    '''
+    recipe
+        the ingredients as [{'color': string, 'name':string, 'parts':number}]
+        setting it replaces the ingredients of the drink
+        raises KeyError, TypeError or ValueError if an ingredient is malformed
+    '''
+    @property
+    def recipe(self):
+        return [ingredient.long() for ingredient in self.ingredients]
+
+    @recipe.setter
+    def recipe(self, recipe):
+        self.ingredients = [
+            Ingredient(position=position, name=r['name'], color=r['color'],
+                       parts=int(r['parts']))
+            for position, r in enumerate(recipe)]
+        self.total_parts = sum(i.parts for i in self.ingredients)
+
+    '''
+    search(ingredients, max_parts)
+        a query of the drinks which contain all the ingredients, matched
+        by their name_key, and have at most max_parts parts in total
+        answered from the indexes, the recipes are not scanned
+    '''
+    @staticmethod
+    def search(ingredients=(), max_parts=None):
+        query = Drink.query
+        keys = {ingredient_key(name) for name in ingredients}
+        if keys:
+            matching = db.session.query(Ingredient.drink_id) \
+                .filter(Ingredient.name_key.in_(keys)) \
+                .group_by(Ingredient.drink_id) \
+                .having(func.count(distinct(Ingredient.name_key)) == len(keys))
+            query = query.filter(Drink.id.in_(matching))
+        if max_parts is not None:
+            query = query.filter(Drink.total_parts <= max_parts)
+        return query.order_by(Drink.id)
 
     '''
     short()
         short form representation of the Drink model
     '''
     def short(self):
-        print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': short_recipe
+            'recipe': [ingredient.short() for ingredient in self.ingredients]
         }
 
     '''
@@ -63,7 +265,7 @@ class Drink(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': self.recipe
         }
 
     '''
@@ -104,4 +306,60 @@ class Drink(db.Model):
         db.session.commit()
 
     def __repr__(self):
-        return json.dumps(self.short())
\ No newline at end of file
+        return json.dumps(self.short())
+
+
+'''
+ingredient_key(name)
+    the normalized name of an ingredient used for searching,
+    e.g. ' Oat  Milk' and 'oat milk' have the same key
+'''
+def ingredient_key(name):
+    return ' '.join(str(name).split()).casefold()
+
+'''
+Ingredient
+an ingredient of the recipe of a drink, stored as its own row
+so that reading a recipe does not parse a json blob
+'''
+class Ingredient(db.Model):
+    # drinks by ingredient, without reading the ingredient rows
+    __table_args__ = (
+        Index('ix_ingredient_name_key_drink_id', 'name_key', 'drink_id'),
+    )
+
+    id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
+    drink_id = Column(Integer, ForeignKey('drink.id'), nullable=False, index=True)
+    # order of the ingredient in the recipe
+    position = Column(Integer, nullable=False)
+    name = Column(String(80), nullable=False)
+    # ingredient_key(name), kept in sync with the name
+    name_key = Column(String(80), nullable=False)
+    color = Column(String(80), nullable=False)
+    parts = Column(Integer, nullable=False)
+
+    @validates('name')
+    def validate_name(self, key, name):
+        self.name_key = ingredient_key(name)
+        return name
+
+    '''
+    short()
+        short form representation of the Ingredient model, without its name
+    '''
+    def short(self):
+        return {
+            'color': self.color,
+            'parts': self.parts
+        }
+
+    '''
+    long()
+        long form representation of the Ingredient model
+    '''
+    def long(self):
+        return {
+            'color': self.color,
+            'name': self.name,
+            'parts': self.parts
+        }
@@ -0,0 +1,81 @@
+import json
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+
+from .database.models import Drink
+
+'''
+the encoded json body of a menu response and its ETag
+'''
+MenuBody = namedtuple('MenuBody', ['body', 'etag'])
+Menu = namedtuple('Menu', ['built_at', 'short', 'long'])
+
+
+def encode_menu(drinks):
+    body = json.dumps({
+        'success': True,
+        'drinks': drinks,
+    }, separators=(',', ':')).encode()
+    return MenuBody(body, hashlib.sha1(body).hexdigest())
+
+
+'''
+MenuCache
+    the pre-encoded bodies of GET /drinks (short) and GET /drinks-detail
+    (long), so that menu reads do not touch the database.
+    refresh() rebuilds both after a write and swaps them in at once.
+    the menu is also rebuilt when it is older than max_age seconds,
+    to pick up the writes of other worker processes.
+    every refresh starts a new generation, a menu built during an older
+    generation is not swapped in, so it cannot replace a newer menu.
+'''
+class MenuCache:
+
+    def __init__(self, max_age=30):
+        self.max_age = max_age
+        self._menu = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _swap(self, generation, menu):
+        with self._lock:
+            if generation == self._generation:
+                self._menu = menu
+
+    def build(self):
+        drinks = Drink.query.order_by(Drink.id).all()
+        return Menu(
+            built_at=time.monotonic(),
+            short=encode_menu([drink.short() for drink in drinks]),
+            long=encode_menu([drink.long() for drink in drinks]),
+        )
+
+    '''
+    refresh()
+        rebuilds the menu, to be called once the drinks are committed
+        if the rebuild fails, the next read rebuilds it
+    '''
+    def refresh(self):
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            self._menu = None
+        try:
+            self._swap(generation, self.build())
+        except Exception:
+            current_app.logger.exception('Rebuilding the menu cache failed')
+
+    '''
+    get(detail)
+        the MenuBody of the long menu if detail, else of the short menu
+    '''
+    def get(self, detail=False):
+        menu = self._menu
+        if menu is None or time.monotonic() - menu.built_at > self.max_age:
+            generation = self._generation
+            menu = self.build()
+            self._swap(generation, menu)
+        return menu.long if detail else menu.short
@@ -0,0 +1,286 @@
+import os
+import tempfile
+import time
+import unittest
+import json
+
+# the tests run on a database file of their own
+DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + DATABASE_FILE
+
+from src.api import app, menu_cache
+from src.auth.auth import token_cache
+from src.database.models import (
+    db, db_create_all, db_drop_and_create_all, Drink, Ingredient)
+
+# the drink table of the first release, with the recipe as a json string
+FIRST_RELEASE_DRINK_TABLE = (
+    'CREATE TABLE drink (id INTEGER NOT NULL, title VARCHAR(80), '
+    'recipe VARCHAR(180) NOT NULL, PRIMARY KEY (id), UNIQUE (title))')
+
+
+class DrinkBatchTestCase(unittest.TestCase):
+    """This class represents the test case of POST /drinks/batch"""
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db_drop_and_create_all()
+        self.client = app.test_client
+
+        token_cache.put('barista-token', {
+            'sub': 'test|barista', 'exp': time.time() + 60,
+            'permissions': ['post:drinks', 'patch:drinks', 'delete:drinks']})
+        self.header = {'Authorization': 'Bearer barista-token'}
+        self.recipe = [{'name': 'milk', 'color': 'grey', 'parts': 1}]
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        self.app_context.pop()
+
+    def batch(self, operations, status=200):
+        res = self.client().post('/drinks/batch', headers=self.header,
+                                 json={'operations': operations})
+        self.assertEqual(res.status_code, status)
+        return json.loads(res.data)
+
+    def test_batch_is_committed(self):
+        data = self.batch([
+            {'op': 'create', 'title': 'flat white', 'recipe': self.recipe},
+            {'op': 'update', 'id': 1, 'title': 'mocha'},
+            {'op': 'delete', 'id': 1},
+        ])
+
+        self.assertTrue(data['success'])
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['created', 'updated', 'deleted'])
+        self.assertEqual(data['results'][0]['drink']['title'], 'flat white')
+        self.assertEqual(Drink.query.count(), 0)
+
+    def test_failed_batch_is_rolled_back(self):
+        data = self.batch([
+            {'op': 'create', 'title': 'flat white', 'recipe': self.recipe},
+            {'op': 'update', 'id': 99, 'title': 'mocha'},
+            {'op': 'create', 'title': 'latte', 'recipe': self.recipe},
+        ], status=422)
+
+        self.assertFalse(data['success'])
+        self.assertEqual(data['results'], [
+            {'index': 0, 'op': 'create', 'status': 'rolled_back'},
+            {'index': 1, 'op': 'update', 'status': 'failed',
+             'error': 'resource not found'},
+            {'index': 2, 'op': 'create', 'status': 'skipped'},
+        ])
+        self.assertEqual(Drink.query.count(), 0)
+
+    def test_malformed_ingredient(self):
+        data = self.batch([
+            {'op': 'create', 'title': 'latte',
+             'recipe': [{'name': 'milk', 'color': 'grey'}]},
+        ], status=422)
+
+        self.assertEqual(data['results'][0]['error'], 'invalid drink')
+        self.assertEqual(Drink.query.count(), 0)
+
+    def test_permissions_of_the_batch(self):
+        token_cache.put('maker-token', {
+            'sub': 'test|maker', 'exp': time.time() + 60,
+            'permissions': ['post:drinks']})
+        res = self.client().post('/drinks/batch', json={'operations': [
+            {'op': 'create', 'title': 'latte', 'recipe': self.recipe},
+            {'op': 'delete', 'id': 1},
+        ]}, headers={'Authorization': 'Bearer maker-token'})
+
+        self.assertEqual(res.status_code, 403)
+
+    def test_malformed_batch(self):
+        self.batch([{'op': 'upsert'}], status=400)
+        self.batch([], status=400)
+
+
+class MenuCacheTestCase(unittest.TestCase):
+    """This class represents the test case of the cached GET /drinks and
+    GET /drinks-detail"""
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db_drop_and_create_all()
+        menu_cache.refresh()
+        self.client = app.test_client
+
+        token_cache.put('manager-token', {
+            'sub': 'test|manager', 'exp': time.time() + 60,
+            'permissions': ['get:drinks-detail', 'post:drinks',
+                            'patch:drinks', 'delete:drinks']})
+        self.header = {'Authorization': 'Bearer manager-token'}
+        self.recipe = [{'name': 'milk', 'color': 'grey', 'parts': 1}]
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        self.app_context.pop()
+
+    def menus(self):
+        """the body and ETag of GET /drinks and GET /drinks-detail"""
+        menus = []
+        for path in ('/drinks', '/drinks-detail'):
+            res = self.client().get(path, headers=self.header)
+            self.assertEqual(res.status_code, 200)
+            menus.append((res.data, res.headers['ETag']))
+        return menus
+
+    def test_if_none_match(self):
+        for path in ('/drinks', '/drinks-detail'):
+            res = self.client().get(path, headers=self.header)
+            self.assertTrue(res.headers['ETag'])
+
+            res = self.client().get(path, headers=dict(
+                self.header, **{'If-None-Match': res.headers['ETag']}))
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.data, b'')
+
+    def test_writes_change_the_menu(self):
+        writes = [
+            ('post', '/drinks',
+             {'title': 'latte', 'recipe': self.recipe}),
+            ('patch', '/drinks/1', {'title': 'flat white'}),
+            ('post', '/drinks/batch', {'operations': [
+                {'op': 'create', 'title': 'mocha', 'recipe': self.recipe}]}),
+            ('delete', '/drinks/1', None),
+        ]
+        menus = self.menus()
+        for method, path, body in writes:
+            res = getattr(self.client(), method)(
+                path, json=body, headers=self.header)
+            self.assertEqual(res.status_code, 200, path)
+
+            changed = self.menus()
+            for (old_body, old_etag), (new_body, new_etag) in zip(
+                    menus, changed):
+                self.assertNotEqual(new_body, old_body, path)
+                self.assertNotEqual(new_etag, old_etag, path)
+            menus = changed
+
+
+class SchemaUpgradeTestCase(unittest.TestCase):
+    """This class tests flask init-db on a database of the first release,
+    created before the total_parts and name_key columns"""
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.session.execute(FIRST_RELEASE_DRINK_TABLE)
+        db.session.execute(
+            "INSERT INTO drink (id, title, recipe) VALUES (1, 'latte', "
+            "'[{\"name\": \" Oat  Milk\", \"color\": \"grey\", \"parts\": 2}, "
+            "{\"name\": \"espresso\", \"color\": \"brown\", \"parts\": 1}]')")
+        db.session.commit()
+
+        token_cache.put('barista-token', {
+            'sub': 'test|barista', 'exp': time.time() + 60,
+            'permissions': ['get:drinks-detail', 'post:drinks']})
+        self.header = {'Authorization': 'Bearer barista-token'}
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_init_db_upgrades_the_tables(self):
+        db_create_all()
+        db_create_all()
+        menu_cache.refresh()
+
+        self.assertEqual([d.title for d in Drink.search(['oat milk'], 3)],
+                         ['latte'])
+        self.assertEqual(Drink.query.get(1).total_parts, 3)
+        client = app.test_client()
+        res = client.get('/drinks?ingredient=espresso')
+        self.assertEqual(res.status_code, 200)
+        res = client.get('/drinks-detail', headers=self.header)
+        self.assertEqual(json.loads(res.data)['drinks'][0]['recipe'], [
+            {'name': ' Oat  Milk', 'color': 'grey', 'parts': 2},
+            {'name': 'espresso', 'color': 'brown', 'parts': 1}])
+
+        res = client.post('/drinks', headers=self.header, json={
+            'title': 'cortado',
+            'recipe': [{'name': 'milk', 'color': 'grey', 'parts': 1}]})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([d.title for d in Drink.search(['milk'])],
+                         ['cortado'])
+
+
+class RecipeUpgradeTestCase(unittest.TestCase):
+    """This class tests flask init-db on a database of the first release,
+    which stored the recipes as json strings"""
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.session.execute(FIRST_RELEASE_DRINK_TABLE)
+        db.session.execute(
+            "INSERT INTO drink (id, title, recipe) VALUES (1, 'water', "
+            "'[{\"name\": \"water\", \"color\": \"blue\", \"parts\": 1}]')")
+        db.session.commit()
+
+        token_cache.put('manager-token', {
+            'sub': 'test|manager', 'exp': time.time() + 60,
+            'permissions': ['get:drinks-detail', 'post:drinks']})
+        self.header = {'Authorization': 'Bearer manager-token'}
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_init_db_moves_the_recipes(self):
+        db_create_all()
+        db_create_all()
+        menu_cache.refresh()
+
+        client = app.test_client()
+        res = client.get('/drinks-detail', headers=self.header)
+        self.assertEqual(json.loads(res.data)['drinks'], [{
+            'id': 1, 'title': 'water',
+            'recipe': [{'name': 'water', 'color': 'blue', 'parts': 1}]}])
+        res = client.post('/drinks', headers=self.header, json={
+            'title': 'latte',
+            'recipe': [{'name': 'milk', 'color': 'grey', 'parts': 1}]})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Ingredient.query.count(), 2)
+
+    def test_init_db_command(self):
+        result = app.test_cli_runner().invoke(args=['init-db'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('moved the json recipes into ingredient rows',
+                      result.output)
+        self.assertEqual(Drink.query.get(1).recipe, [
+            {'name': 'water', 'color': 'blue', 'parts': 1}])
+
+    def test_malformed_recipe_is_not_upgraded(self):
+        db.session.execute(
+            "INSERT INTO drink (id, title, recipe) VALUES (2, 'tea', "
+            "'[{\"name\": \"tea\"}]')")
+        db.session.commit()
+
+        with self.assertRaises(ValueError):
+            db_create_all()
+        result = app.test_cli_runner().invoke(args=['init-db'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('drink 2 has a malformed recipe', result.output)
+        self.assertIn('flask init-db --drop', result.output)
+        self.assertEqual(db.session.execute(
+            'SELECT COUNT(*) FROM drink WHERE recipe IS NOT NULL').scalar(), 2)
+        self.assertEqual(Ingredient.query.count(), 0)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
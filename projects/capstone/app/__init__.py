@@ -1,11 +1,28 @@
-from flask import Flask
+import sqlite3
+from flask import Flask, current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from config import config
 
 
 db = SQLAlchemy()
 
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    applies the SQLITE_PRAGMAS of the current app to a new SQLite connection
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection) or \
+            not has_app_context():
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in current_app.config.get('SQLITE_PRAGMAS', {}).items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
 def create_app(config_name):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
@@ -13,14 +30,44 @@ def create_app(config_name):
 
     db.init_app(app)
 
-    from .auth import auth as auth_blueprint
+    from .auth import auth_blueprint
     app.register_blueprint(auth_blueprint, url_prefix='/auth')
 
     from .api import api as api_blueprint
     app.register_blueprint(api_blueprint, url_prefix='/api')
 
+    from .api.idempotency import init_idempotency_store
+    init_idempotency_store(app)
+
+    if app.config.get('RATE_LIMIT_PER_SECOND'):
+        from .rate_limit import init_rate_limiter
+        init_rate_limiter(app)
+
+    if app.config.get('BOOKING_QUEUE'):
+        init_booking_queue(app)
+
     @app.route('/')
     def index():
         return 'Hello, Capstone'
 
     return app
+
+
+def init_booking_queue(app):
+    """
+    opens the write-behind booking queue of the app, its workers start
+    with the first request, so that cli commands do not process it
+    """
+    from .booking_queue import BookingQueue
+    from .api.bookings import process_booking_tickets
+
+    queue = BookingQueue(
+        app.config['BOOKING_QUEUE'],
+        batch_size=app.config['BOOKING_QUEUE_BATCH_SIZE'],
+        claim_timeout=app.config['BOOKING_QUEUE_CLAIM_TIMEOUT'])
+    app.extensions['booking_queue'] = queue
+
+    @app.before_first_request
+    def start_booking_queue():
+        queue.start(app, process_booking_tickets,
+                    app.config['BOOKING_QUEUE_WORKERS'])
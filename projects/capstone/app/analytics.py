@@ -0,0 +1,139 @@
+"""
+fleet utilization analytics
+
+Utilization is the booked time of the vehicles over the time they were
+available, per day, week or month. The booked time is summed from the
+daily rollup VehicleDailyUsage, which has at most one row per vehicle
+and day, instead of the bookings. The peak concurrency, the largest
+number of vehicles booked at the same time, is computed by a single
+sweep over the start and end times of the bookings of the range.
+"""
+from datetime import datetime, timedelta
+from . import db
+from .models import Booking, Vehicle, VehicleDailyUsage
+
+GRANULARITIES = ('day', 'week', 'month')
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def period_start(day, granularity):
+    """
+    the first day of the day, week (starting on Monday) or month of day
+    """
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_period(start, granularity):
+    """
+    the first day of the period after the one starting at start
+    """
+    if granularity == 'week':
+        return start + timedelta(days=7)
+    if granularity == 'month':
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def periods(start, end, granularity):
+    """
+    the (first day, day after the last day) of the periods of [start, end),
+    the first and last periods are clipped to the range
+    """
+    result = []
+    first = start
+    while first < end:
+        after = min(next_period(period_start(first, granularity),
+                                granularity), end)
+        result.append((first, after))
+        first = after
+    return result
+
+
+def peak_concurrency(start, end, granularity, vehicle_VIN=None):
+    """
+    the largest number of bookings at the same time in each period,
+    keyed by the first day of the period
+    """
+    range_start = datetime.combine(start, datetime.min.time())
+    range_end = datetime.combine(end, datetime.min.time())
+    bounds = periods(start, end, granularity)
+
+    query = db.session.query(Booking.start_datetime, Booking.end_datetime) \
+        .filter(Booking.start_datetime < range_end,
+                Booking.end_datetime > range_start)
+    if vehicle_VIN is not None:
+        query = query.filter(Booking.vehicle_VIN == vehicle_VIN)
+
+    # at the same time ends (-1) come before period bounds (0) and
+    # starts (+1), so that back to back bookings do not overlap
+    events = [(datetime.combine(first, datetime.min.time()), 0)
+              for first, _ in bounds]
+    for booking_start, booking_end in query.yield_per(1000):
+        events.append((max(booking_start, range_start), 1))
+        events.append((min(booking_end, range_end), -1))
+    events.sort()
+
+    peaks = {first: 0 for first, _ in bounds}
+    firsts = [first for first, _ in bounds]
+    period = -1
+    current = 0
+    for time, delta in events:
+        while period + 1 < len(firsts) and \
+                time.date() >= firsts[period + 1]:
+            period += 1
+        current += delta
+        if period >= 0 and time < range_end:
+            peaks[firsts[period]] = max(peaks[firsts[period]], current)
+    return peaks
+
+
+def utilization(start, end, granularity='day', vehicle_VIN=None):
+    """
+    the booked hours, available hours, utilization and peak concurrency
+    of the fleet, or of a single vehicle, in each period of [start, end),
+    with the booked hours and utilization of each booked vehicle
+    """
+    query = db.session.query(
+        VehicleDailyUsage.vehicle_VIN, VehicleDailyUsage.day,
+        VehicleDailyUsage.booked_seconds,
+    ).filter(VehicleDailyUsage.day >= start, VehicleDailyUsage.day < end,
+             VehicleDailyUsage.booked_seconds > 0)
+    if vehicle_VIN is not None:
+        query = query.filter(VehicleDailyUsage.vehicle_VIN == vehicle_VIN)
+        fleet_size = 1
+    else:
+        fleet_size = Vehicle.query.count()
+
+    # booked seconds by vehicle, by the first day of the unclipped period
+    booked = {}
+    for vin, day, seconds in query:
+        vehicles = booked.setdefault(period_start(day, granularity), {})
+        vehicles[vin] = vehicles.get(vin, 0) + seconds
+
+    peaks = peak_concurrency(start, end, granularity, vehicle_VIN)
+    result = []
+    for first, after in periods(start, end, granularity):
+        vehicle_seconds = (after - first).days * SECONDS_PER_DAY
+        vehicles = sorted(
+            booked.get(period_start(first, granularity), {}).items())
+        booked_seconds = sum(seconds for _, seconds in vehicles)
+        available_seconds = vehicle_seconds * fleet_size
+        result.append({
+            'start': first.isoformat(),
+            'end': after.isoformat(),
+            'booked_hours': booked_seconds / 3600,
+            'available_hours': available_seconds / 3600,
+            'utilization': booked_seconds / available_seconds
+            if available_seconds else None,
+            'peak_concurrency': peaks[first],
+            'vehicles': [{
+                'VIN': vin,
+                'booked_hours': seconds / 3600,
+                'utilization': seconds / vehicle_seconds,
+            } for vin, seconds in vehicles],
+        })
+    return result
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 api = Blueprint('api', __name__)
 
-from . import vehicles, clients, bookings, errors
\ No newline at end of file
+from . import vehicles, clients, bookings, analytics, errors
\ No newline at end of file
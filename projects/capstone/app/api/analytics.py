@@ -0,0 +1,41 @@
+from datetime import date
+from flask import abort
+from . import api
+from .listing import parse_arg
+from ..analytics import GRANULARITIES, utilization
+from ..serialization import json_response
+
+MAX_RANGE_DAYS = 366
+
+
+@api.route("/analytics/utilization", methods=["GET"])
+def get_utilization():
+    """
+    public endpoint GET /analytics/utilization
+    the utilization and peak concurrency of the fleet per period
+    query parameters:
+        start, end: ISO 8601 dates of the range, the end is excluded,
+            required, at most 366 days apart
+        granularity: 'day' (default), 'week' or 'month'
+        vehicle_VIN: only the given vehicle, optional
+    Returns:
+        status code 200 and json {"success": True, "granularity": granularity, "periods": periods} where periods is the list of the periods of the range
+        appropriate status code indicating reason for failure
+    """
+    start = parse_arg('start', date.fromisoformat)
+    end = parse_arg('end', date.fromisoformat)
+    granularity = parse_arg('granularity', str) or 'day'
+    vehicle_VIN = parse_arg('vehicle_VIN', int)
+    if start is None or end is None or granularity not in GRANULARITIES:
+        abort(400)
+    if not 0 < (end - start).days <= MAX_RANGE_DAYS:
+        abort(400)
+
+    try:
+        return json_response({
+            "success": True,
+            "granularity": granularity,
+            "periods": utilization(start, end, granularity, vehicle_VIN),
+        })
+    except:
+        abort(500)
@@ -0,0 +1,209 @@
+"""
+batch endpoints
+
+A batch is a list of create, update and delete operations, e.g.
+    {"operations": [
+        {"op": "create", "make": "BMW", "model": "530 Sedan"},
+        {"op": "update", "VIN": 10006, "model_year": 2010},
+        {"op": "delete", "VIN": 11234}]}
+The token is verified and the permissions for all kinds of operations
+of the batch are checked once. Every operation is validated on its own
+and the valid ones are committed CHUNK_SIZE at a time. If the database
+rejects a chunk, its operations are retried one by one, so that only
+the rejected operations fail. The response has the result of every
+operation and the throughput of the batch.
+"""
+import time
+from flask import request, abort
+from sqlalchemy import Boolean, Integer, String
+from sqlalchemy.exc import SQLAlchemyError
+from .. import db
+from ..auth.auth import check_permissions, current_permissions
+from ..serialization import json_response
+
+MAX_BATCH_SIZE = 1000
+CHUNK_SIZE = 100
+
+# the permission action required by each kind of operation
+ACTIONS = {
+    'create': 'post',
+    'update': 'patch',
+    'delete': 'delete',
+}
+
+
+def validate_fields(model, fields, values):
+    """
+    the errors of the values of the fields by field name, checked against
+    the types and lengths of the columns of the model. values of other
+    fields than the given ones are errors
+    """
+    errors = {}
+    for name, value in values.items():
+        if name not in fields:
+            errors[name] = 'unknown field'
+            continue
+        if value is None:
+            continue
+        column_type = model.__table__.columns[name].type
+        if isinstance(column_type, Boolean):
+            valid = isinstance(value, bool)
+        elif isinstance(column_type, Integer):
+            valid = isinstance(value, int) and not isinstance(value, bool)
+        elif isinstance(column_type, String):
+            valid = isinstance(value, str) and (
+                column_type.length is None or
+                len(value) <= column_type.length)
+        else:
+            valid = True
+        if not valid:
+            errors[name] = f'invalid {column_type}'
+    return errors
+
+
+class Batch:
+    """
+    the batch operations of a model
+    Inputs:
+        model: the model class, e.g. Vehicle
+        key: the name of its primary key, e.g. 'VIN'
+        fields: the names of the fields which may be set
+        resource: the resource of the permissions, e.g. 'vehicles'
+    """
+
+    def __init__(self, model, key, fields, resource):
+        self.model = model
+        self.key = key
+        self.fields = fields
+        self.resource = resource
+
+    def validate(self, operation):
+        """
+        the errors of the operation, empty if it is valid
+        """
+        values = {name: value for name, value in operation.items()
+                  if name not in ('op', self.key)}
+        if operation['op'] == 'create':
+            return validate_fields(self.model, self.fields, values)
+        key = operation.get(self.key)
+        if not isinstance(key, int) or isinstance(key, bool):
+            return {self.key: 'required'}
+        if operation['op'] == 'delete':
+            return {name: 'unknown field' for name in values}
+        return validate_fields(self.model, self.fields, values)
+
+    def apply(self, operation):
+        """
+        applies the valid operation to the session and flushes it
+        Raises:
+            LookupError: if the row to update or delete does not exist
+            SQLAlchemyError: if the database rejects the operation
+        Returns:
+            the result of the operation
+        """
+        kind = operation['op']
+        values = {name: value for name, value in operation.items()
+                  if name in self.fields}
+        if kind == 'create':
+            row = self.model(**values)
+            db.session.add(row)
+            db.session.flush()
+            return {'status': 'created', self.key: getattr(row, self.key)}
+
+        row = self.model.query.get(operation[self.key])
+        if row is None:
+            raise LookupError('resource not found')
+        if kind == 'delete':
+            db.session.delete(row)
+        else:
+            for name, value in values.items():
+                setattr(row, name, value)
+        db.session.flush()
+        return {'status': f'{kind}d', self.key: operation[self.key]}
+
+    def apply_chunk(self, chunk):
+        """
+        applies and commits the (index, operation) pairs of the chunk
+        Returns:
+            the results by index
+        """
+        results = {}
+        try:
+            for index, operation in chunk:
+                try:
+                    results[index] = self.apply(operation)
+                except LookupError as e:
+                    results[index] = {'status': 'failed', 'error': str(e)}
+            db.session.commit()
+            return results
+        except SQLAlchemyError:
+            db.session.rollback()
+
+        # isolate the operations the database rejects
+        for index, operation in chunk:
+            try:
+                results[index] = self.apply(operation)
+                db.session.commit()
+            except LookupError as e:
+                db.session.rollback()
+                results[index] = {'status': 'failed', 'error': str(e)}
+            except SQLAlchemyError:
+                db.session.rollback()
+                results[index] = {'status': 'failed',
+                                  'error': 'rejected by the database'}
+        return results
+
+    def response(self, payload):
+        """
+        runs the batch of the request for the verified token payload
+        Returns:
+            status code 200 and json {"success": True, "results": results, "stats": stats}
+        """
+        started = time.perf_counter()
+        body = request.get_json(silent=True)
+        operations = body.get('operations') if isinstance(body, dict) \
+            else None
+        if not isinstance(operations, list) or \
+                not 0 < len(operations) <= MAX_BATCH_SIZE or \
+                any(not isinstance(operation, dict) or
+                    operation.get('op') not in ACTIONS
+                    for operation in operations):
+            abort(400)
+        check_permissions(sorted({f"{ACTIONS[operation['op']]}:"
+                                  f"{self.resource}"
+                                  for operation in operations}),
+                          current_permissions())
+
+        results = []
+        valid = []
+        for index, operation in enumerate(operations):
+            errors = self.validate(operation)
+            results.append({'index': index, 'op': operation['op']})
+            if errors:
+                results[index].update(status='invalid', errors=errors)
+            else:
+                valid.append((index, operation))
+
+        chunks = 0
+        for start in range(0, len(valid), CHUNK_SIZE):
+            chunk_results = self.apply_chunk(valid[start:start + CHUNK_SIZE])
+            for index, result in chunk_results.items():
+                results[index].update(result)
+            chunks += 1
+
+        seconds = time.perf_counter() - started
+        succeeded = sum(1 for result in results
+                        if result['status'] not in ('invalid', 'failed'))
+        return json_response({
+            'success': True,
+            'results': results,
+            'stats': {
+                'operations': len(operations),
+                'succeeded': succeeded,
+                'failed': len(operations) - succeeded,
+                'chunks': chunks,
+                'seconds': seconds,
+                'operations_per_second': len(operations) / seconds
+                if seconds else None,
+            },
+        })
@@ -1,23 +1,161 @@
-from flask import jsonify, request
+from datetime import datetime
+from flask import current_app, request, abort
+from sqlalchemy.exc import SQLAlchemyError
 from . import api
+from .. import db
 from ..auth.auth import requires_auth
-from ..models import Booking
+from ..rate_limit import rate_limited
+from .idempotency import idempotent
+from ..models import Booking, Vehicle, VehicleDailyUsage
+from .partial_update import PartialUpdate, supports_returning
+from .listing import (keyset_page, ndjson_response, parse_arg, parse_fields,
+                      parse_limit, wants_ndjson)
+from ..serialization import json_response
+
+BOOKING_COLUMNS = (Booking.id, Booking.vehicle_VIN, Booking.client_id,
+                   Booking.start_datetime, Booking.end_datetime)
+BOOKING_FIELDS = {column.key: column for column in BOOKING_COLUMNS}
+BOOKING_UPDATE = PartialUpdate(Booking, 'id', ('vehicle_VIN', 'client_id',
+                                               'start_datetime',
+                                               'end_datetime'))
+
+
+def parse_datetime(value):
+    """
+    the datetime of an ISO 8601 string, e.g. '2018-08-08T09:00:00.000000'
+    Raises:
+        TypeError, ValueError: if the value is not such a string
+    """
+    if isinstance(value, str) and value.endswith('Z'):
+        value = value[:-1]
+    return datetime.fromisoformat(value)
+
+
+def lock_vehicle(vin):
+    """
+    the vehicle with its row locked until the end of the transaction, so
+    that concurrent bookings of the same vehicle are checked one after
+    another. SQLite has no row locks and ignores FOR UPDATE
+    """
+    return Vehicle.query.filter_by(VIN=vin).with_for_update().one_or_none()
+
+
+def insert_booking(vehicle_VIN, client_id, start, end):
+    """
+    inserts the booking unless the vehicle is booked in [start, end),
+    within the transaction of the session. the overlap check is the
+    condition of the INSERT ... SELECT itself, so that of two concurrent
+    overlapping bookings only one is inserted, also on SQLite
+    Returns:
+        the id of the booking, None if the vehicle is already booked
+    """
+    table = Booking.__table__
+    values = {'vehicle_VIN': vehicle_VIN, 'client_id': client_id,
+              'start_datetime': start, 'end_datetime': end}
+    row = db.select([db.literal(value, type_=table.c[name].type)
+                     for name, value in values.items()]) \
+        .where(Booking.is_vehicle_free(vehicle_VIN, start, end))
+    statement = table.insert().from_select(list(values), row)
+    if supports_returning():
+        booking_id = db.session.execute(
+            statement.returning(table.c.id)).scalar()
+    else:
+        result = db.session.execute(statement)
+        booking_id = result.lastrowid if result.rowcount else None
+    if booking_id is not None:
+        # the statement bypasses the listeners of the rollup
+        VehicleDailyUsage.add(db.session.connection(), vehicle_VIN,
+                              start, end)
+    return booking_id
+
+
+def create_booking(values):
+    """
+    inserts the booking of a queued ticket, after the same checks as
+    POST /bookings
+    Returns:
+        the result of the ticket
+    """
+    start = parse_datetime(values['start_datetime'])
+    end = parse_datetime(values['end_datetime'])
+    vehicle = lock_vehicle(values['vehicle_VIN'])
+    if vehicle is None:
+        return {'status': 'failed', 'error': 'vehicle not found'}
+    booking_id = insert_booking(vehicle.VIN, values.get('client_id'),
+                                start, end)
+    if booking_id is None:
+        return {'status': 'conflict', 'error': 'vehicle already booked'}
+    return {'status': 'created', 'booking_id': booking_id}
+
+
+def process_booking_tickets(batch):
+    """
+    creates the bookings of a batch of queued (ticket, values) pairs in
+    one transaction. if the database rejects it, the tickets are retried
+    one by one
+    Returns:
+        the result of each ticket
+    """
+    try:
+        results = {ticket: create_booking(values) for ticket, values in batch}
+        db.session.commit()
+        return results
+    except SQLAlchemyError:
+        db.session.rollback()
+
+    results = {}
+    for ticket, values in batch:
+        try:
+            results[ticket] = create_booking(values)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            results[ticket] = {'status': 'failed',
+                               'error': 'rejected by the database'}
+    return results
 
 
 @api.route("/bookings", methods=["GET"])
 def get_bookings():
     """
     public endpoint GET /bookings
-    contains the booking json data representation
+    contains the booking json data representation, one page ordered by id
+    query parameters, all optional:
+        after: the next_cursor of the previous page
+        limit: the number of bookings of a page, at most 1000
+        fields: comma separated fields to return, the id is always returned
+        client_id, vehicle_VIN: only bookings of this client or vehicle
+        start, end: ISO 8601 datetimes, only bookings overlapping the window
     Returns:
-        status code 200 and json {"success": True, "bookings": bookings} where bookings is the list of bookings
+        status code 200 and json {"success": True, "bookings": bookings, "next_cursor": cursor} where bookings is the list of bookings and cursor is null on the last page
         appropriate status code indicating reason for failure
     """
+    after = parse_arg('after', int)
+    limit = parse_limit()
+    columns = parse_fields(BOOKING_FIELDS, 'id')
+    client_id = parse_arg('client_id', int)
+    vehicle_VIN = parse_arg('vehicle_VIN', int)
+    start = parse_arg('start', parse_datetime)
+    end = parse_arg('end', parse_datetime)
+
     try:
-        bookings = [b.to_json() for b in Booking.query.all()]
-        return jsonify({
+        query = Booking.query
+        if client_id is not None:
+            query = query.filter(Booking.client_id == client_id)
+        if vehicle_VIN is not None:
+            query = query.filter(Booking.vehicle_VIN == vehicle_VIN)
+        if start is not None:
+            query = query.filter(Booking.end_datetime > start)
+        if end is not None:
+            query = query.filter(Booking.start_datetime < end)
+        if wants_ndjson():
+            return ndjson_response(query, Booking.id, columns, after)
+        bookings, next_cursor = keyset_page(query, Booking.id, columns,
+                                            after, limit)
+        return json_response({
             "success": True,
             "bookings": bookings,
+            "next_cursor": next_cursor,
         })
     except:
         abort(500)
@@ -35,7 +173,7 @@ def get_booking(id):
     """
     try:
         booking = Booking.query.get_or_404(id)
-        return jsonify({
+        return json_response({
             "success": True,
             "bookings": [booking.to_json()],
         })
@@ -45,69 +183,160 @@ def get_booking(id):
 
 @api.route("/bookings", methods=["POST"])
 @requires_auth('post:bookings')
-def post_booking():
+@rate_limited
+@idempotent
+def post_booking(payload):
     """
     endpoint POST /bookings
     creates a new row in the bookings table
     requires the 'post:bookings' permission
+    responds with a 409 error if the vehicle is already booked in the period
+    with the booking queue enabled, the booking is queued after it was
+    validated, and the ticket is polled with GET /bookings/tickets/<ticket>
     contains the booking json data representation
     Returns:
         status code 200 and json {"success": True, "bookings": booking} where booking an array containing only the newly created booking
+        status code 202 and json {"success": True, "ticket": ticket} if the booking was queued
         appropriate status code indicating reason for failure
     """
     body = request.get_json()
-
-    booking = Booking(
-        vehicle_VIN=body.get('vehicle_VIN'),
-        client_id=body.get('client_id'),
-        start_datetime=body.get('start_datetime'),
-        end_datetime=body.get('end_datetime'),
-    )
     try:
-        booking.insert()
-        return jsonify({
-            'success': True,
-            'booking_id': booking.id,
+        start = parse_datetime(body.get('start_datetime'))
+        end = parse_datetime(body.get('end_datetime'))
+    except (TypeError, ValueError):
+        abort(400)
+    if start >= end:
+        abort(400)
+
+    queue = current_app.extensions.get('booking_queue')
+    if queue is not None:
+        if Vehicle.query.get(body.get('vehicle_VIN')) is None:
+            abort(422)
+        ticket = queue.enqueue({
+            'vehicle_VIN': body.get('vehicle_VIN'),
+            'client_id': body.get('client_id'),
+            'start_datetime': start.isoformat(),
+            'end_datetime': end.isoformat(),
         })
-    except:
+        return json_response({
+            'success': True,
+            'ticket': ticket,
+        }, 202)
+
+    vehicle = lock_vehicle(body.get('vehicle_VIN'))
+    if vehicle is None:
+        db.session.rollback()
         abort(422)
+    try:
+        booking_id = insert_booking(vehicle.VIN, body.get('client_id'),
+                                    start, end)
+        if booking_id is None:
+            db.session.rollback()
+            abort(409)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+    return json_response({
+        'success': True,
+        'booking_id': booking_id,
+    })
+
+
+@api.route('/bookings/tickets/<ticket>', methods=['GET'])
+@requires_auth('post:bookings')
+def get_booking_ticket(payload, ticket):
+    """
+    endpoint GET /bookings/tickets/<ticket>, where <ticket> was returned
+    by POST /bookings with the booking queue enabled
+    responds with a 404 error if <ticket> is not found
+    requires the 'post:bookings' permission
+    Returns:
+        status code 200 and json {"success": True, "ticket": ticket, "status": status} where status is 'pending', 'processing', 'created' with the "booking_id", 'conflict' or 'failed' with an "error"
+        appropriate status code indicating reason for failure
+    """
+    queue = current_app.extensions.get('booking_queue')
+    status = queue.status(ticket) if queue is not None else None
+    if status is None:
+        abort(404)
+    return json_response(dict(status, success=True, ticket=ticket))
 
 
 @api.route('/bookings/<int:id>', methods=['PATCH'])
 @requires_auth('patch:bookings')
+@rate_limited
+@idempotent
 def patch_booking(payload, id):
     """
     endpoint PATCH /bookings/<id>, where <id> is the existing model id
     responds with a 404 error if <id> is not found
     updates the corresponding row for <id>
     requires the 'patch:bookings' permission
+    responds with a 409 error if the vehicle is already booked in the period
+    responds with a 422 error if the vehicle or the client does not exist
     contains the booking json data representation
+    body: the fields to set, any of vehicle_VIN, client_id, start_datetime
+        and end_datetime. responds with a 400 error for other fields or
+        values of the wrong type
     Returns:
-        status code 200 and json {"success": True, "bookings": booking} where booking an array containing only the updated booking
+        status code 200 and json {"success": True, "booking_id": id, "bookings": booking} where booking an array containing only the updated booking
         appropriate status code indicating reason for failure
     """
+    values = BOOKING_UPDATE.parse()
     try:
-        body = request.get_json()
-        booking = Booking.query.get_or_404(id)
-        if 'vehicle_VIN' in body:
-            booking.vehicle_VIN = body.get('vehicle_VIN')
-        if 'client_id' in body:
-            booking.client_id = json.dumps(body.get('client_id'))
-        if 'start_datetime' in body:
-            booking.start_datetime = body.get('start_datetime')
-        if 'end_datetime' in body:
-            booking.end_datetime = json.dumps(body.get('end_datetime'))
-        booking.update()
-        return jsonify({
-            'success': True,
-            'booking_id': booking.id,
-        })
-    except:
-        abort(500)
+        for key in ('start_datetime', 'end_datetime'):
+            if key in values:
+                values[key] = parse_datetime(values[key])
+    except (TypeError, ValueError):
+        abort(400)
+
+    # the booked vehicle and period before the update, for the overlap
+    # check and to be moved in the daily usage rollup
+    old = db.session.query(
+        Booking.vehicle_VIN, Booking.start_datetime, Booking.end_datetime,
+    ).filter(Booking.id == id).with_for_update().first()
+    if old is None:
+        db.session.rollback()
+        abort(404)
+    vehicle_VIN = values.get('vehicle_VIN', old.vehicle_VIN)
+    start = values.get('start_datetime', old.start_datetime)
+    end = values.get('end_datetime', old.end_datetime)
+    if start >= end:
+        db.session.rollback()
+        abort(400)
+    if lock_vehicle(vehicle_VIN) is None:
+        db.session.rollback()
+        abort(422)
+
+    # constraint errors, e.g. of an unknown client_id, are raised by the
+    # update itself, not by the commit
+    try:
+        # the overlap check is the condition of the update itself
+        booking = BOOKING_UPDATE.execute(
+            id, values, Booking.is_vehicle_free(vehicle_VIN, start, end, id))
+        if booking is not None:
+            # the update bypasses the listeners of the rollup
+            if (vehicle_VIN, start, end) != tuple(old):
+                connection = db.session.connection()
+                VehicleDailyUsage.add(connection, *old, sign=-1)
+                VehicleDailyUsage.add(connection, vehicle_VIN, start, end)
+            db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+    if booking is None:
+        db.session.rollback()
+        abort(409)
+    return json_response({
+        'success': True,
+        'booking_id': id,
+        'bookings': [booking],
+    })
 
 
 @api.route('/bookings/<int:id>', methods=['DELETE'])
 @requires_auth('delete:bookings')
+@rate_limited
 def delete_booking(payload, id):
     """
     endpoint DELETE /bookings/<id>, where <id> is the existing model id
@@ -121,7 +350,7 @@ def delete_booking(payload, id):
     try:
         booking = Booking.query.get_or_404(id)
         booking.delete()
-        return jsonify({
+        return json_response({
             'success': True,
             'booking_id': id,
         })
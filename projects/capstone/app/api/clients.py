@@ -1,28 +1,124 @@
-from flask import jsonify, request, abort
+from flask import request, abort
+from sqlalchemy.exc import SQLAlchemyError
 from . import api
+from .. import db
 from ..auth.auth import requires_auth
-from ..models import Client
+from ..rate_limit import rate_limited
+from .idempotency import idempotent
+from .batch import Batch
+from .partial_update import PartialUpdate
+from .listing import (keyset_page, ndjson_response, parse_arg, parse_fields,
+                      parse_limit, wants_ndjson)
+from ..models import Client, MAX_EMAIL_LOOKUP
+from ..serialization import json_response
+
+CLIENT_FIELDS = {
+    'id': Client.id,
+    'forename': Client.forename,
+    'surname': Client.surname,
+    'email': Client.email,
+    'bookings_count': Client.bookings_count(),
+}
+# the fields of the clients looked up by email
+LOOKUP_FIELDS = ('id', 'forename', 'surname', 'email')
+CLIENT_BATCH = Batch(Client, 'id', ('forename', 'surname', 'email'),
+                     'clients')
+CLIENT_UPDATE = PartialUpdate(Client, 'id', CLIENT_BATCH.fields)
 
 
 @api.route("/clients", methods=["GET"])
 def get_clients():
     """
     public endpoint GET /clients
-    contains the client json data representation
+    contains the client json data representation, one page ordered by id
+    query parameters, all optional:
+        after: the next_cursor of the previous page
+        limit: the number of clients of a page, at most 1000
+        fields: comma separated fields to return, the id is always returned
+        surname: only clients with this surname
+        email: only the client with this email, may be repeated. the
+            clients are looked up by email in a single page, without
+            their bookings_count
     Returns:
-        status code 200 and json {"success": True, "clients": clients} where clients is the list of clients
+        status code 200 and json {"success": True, "clients": clients, "next_cursor": cursor} where clients is the list of clients and cursor is null on the last page
         appropriate status code indicating reason for failure
     """
+    emails = request.args.getlist('email')
+    if emails:
+        if len(emails) > MAX_EMAIL_LOOKUP:
+            abort(400)
+        return json_response({
+            "success": True,
+            "clients": lookup_clients(emails)[0],
+            "next_cursor": None,
+        })
+
+    after = parse_arg('after', int)
+    limit = parse_limit()
+    columns = parse_fields(CLIENT_FIELDS, 'id')
+    surname = parse_arg('surname', str)
+
     try:
-        clients = [c.to_json() for c in Client.query.all()]
-        return jsonify({
+        query = Client.query
+        if surname is not None:
+            query = query.filter(Client.surname == surname)
+        if wants_ndjson():
+            return ndjson_response(query, Client.id, columns, after)
+        clients, next_cursor = keyset_page(query, Client.id, columns,
+                                           after, limit)
+        return json_response({
             "success": True,
             "clients": clients,
+            "next_cursor": next_cursor,
         })
     except:
         abort(500)
 
 
+def lookup_clients(emails):
+    """
+    looks up the clients with the emails, with the LOOKUP_FIELDS selected
+    by the 'fields' parameter
+    Returns:
+        the clients found, in the order of the emails, and the emails of
+        no client
+    """
+    names = [column.key for column in parse_fields(
+        {name: CLIENT_FIELDS[name] for name in LOOKUP_FIELDS}, 'id')]
+    found = Client.lookup(emails)
+    emails = list(dict.fromkeys(emails))
+    return ([{name: found[email][name] for name in names}
+             for email in emails if email in found],
+            [email for email in emails if email not in found])
+
+
+@api.route("/clients/lookup", methods=["POST"])
+def post_clients_lookup():
+    """
+    public endpoint POST /clients/lookup
+    looks up many clients by email at once
+        {"emails": ["alan.turing@mustermann.com", ...]}
+    query parameters, all optional:
+        fields: comma separated fields to return, the id is always returned
+    Returns:
+        status code 200 and json {"success": True, "clients": clients, "missing": missing} where clients is the list of the clients found, in the order of the emails, and missing the emails of no client
+        appropriate status code indicating reason for failure
+    """
+    body = request.get_json(silent=True)
+    emails = body.get('emails') if isinstance(body, dict) else None
+    if not isinstance(emails, list) or \
+            not 0 < len(emails) <= MAX_EMAIL_LOOKUP or \
+            any(not isinstance(email, str) for email in emails):
+        abort(400)
+
+    clients, missing = lookup_clients(emails)
+    return json_response({
+        "success": True,
+        "clients": clients,
+        "missing": missing,
+    })
+
+
 @api.route("/clients/<int:id>", methods=["GET"])
 def get_client(id):
     """
@@ -35,7 +131,7 @@ def get_client(id):
     """
     try:
         client = Client.query.get_or_404(id)
-        return jsonify({
+        return json_response({
             "success": True,
             "clients": [client.to_json()],
         })
@@ -45,7 +141,9 @@ def get_client(id):
 
 @api.route("/clients", methods=["POST"])
 @requires_auth('post:clients')
-def post_client():
+@rate_limited
+@idempotent
+def post_client(payload):
     """
     endpoint POST /clients
     creates a new row in the clients table
@@ -64,7 +162,7 @@ def post_client():
     )
     try:
         client.insert()
-        return jsonify({
+        return json_response({
             'success': True,
             'client_id': client.id,
         })
@@ -72,8 +170,28 @@ def post_client():
         abort(422)
 
 
+@api.route("/clients/batch", methods=["POST"])
+@requires_auth()
+@rate_limited
+@idempotent
+def post_clients_batch(payload):
+    """
+    endpoint POST /clients/batch
+    creates, updates and deletes clients in chunked transactions
+        {"operations": [{"op": "create" | "update" | "delete", "id": ..., ...}]}
+    requires 'post:clients', 'patch:clients' and 'delete:clients' for
+    the kinds of operations in the batch, checked once
+    Returns:
+        status code 200 and json {"success": True, "results": results, "stats": stats} where results has the result of each operation and stats the throughput
+        appropriate status code indicating reason for failure
+    """
+    return CLIENT_BATCH.response(payload)
+
+
 @api.route('/clients/<int:id>', methods=['PATCH'])
 @requires_auth('patch:clients')
+@rate_limited
+@idempotent
 def patch_client(payload, id):
     """
     endpoint PATCH /clients/<id>, where <id> is the existing model id
@@ -81,30 +199,33 @@ def patch_client(payload, id):
     updates the corresponding row for <id>
     requires the 'patch:clients' permission
     contains the client json data representation
+    body: the fields to set, any of forename, surname and email. responds
+        with a 400 error for other fields or values of the wrong type
     Returns:
-        status code 200 and json {"success": True, "clients": client} where client an array containing only the updated client
+        status code 200 and json {"success": True, "client_id": id, "clients": client} where client an array containing only the updated client
         appropriate status code indicating reason for failure
     """
+    # the client is updated through the session, whose listeners keep
+    # the email lookup cache up to date
+    values = CLIENT_UPDATE.parse()
+    client = Client.query.get_or_404(id)
+    for name, value in values.items():
+        setattr(client, name, value)
     try:
-        body = request.get_json()
-        client = Client.query.get_or_404(id)
-        if 'forename' in body:
-            client.forename = body.get('forename')
-        if 'surname' in body:
-            client.surname = json.dumps(body.get('surname'))
-        if 'email' in body:
-            client.email = body.get('email')
         client.update()
-        return jsonify({
-            'success': True,
-            'client_id': client.id,
-        })
-    except:
-        abort(500)
+    except SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+    return json_response({
+        'success': True,
+        'client_id': client.id,
+        'clients': [client.to_json()],
+    })
 
 
 @api.route('/clients/<int:id>', methods=['DELETE'])
 @requires_auth('delete:clients')
+@rate_limited
 def delete_client(payload, id):
     """
     endpoint DELETE /clients/<id>, where <id> is the existing model id
@@ -118,7 +239,7 @@ def delete_client(payload, id):
     try:
         client = Client.query.get_or_404(id)
         client.delete()
-        return jsonify({
+        return json_response({
             'success': True,
             'client_id': id,
         })
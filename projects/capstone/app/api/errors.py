@@ -1,5 +1,8 @@
+import math
 from flask import jsonify, request, abort
 from . import api
+from ..auth.auth import AuthError
+from ..rate_limit import RateLimited
 
 # Error Handling
 @api.errorhandler(400)
@@ -29,6 +32,15 @@ def not_found(error):
     }), 404
 
 
+@api.errorhandler(409)
+def conflict(error):
+    return jsonify({
+        'success': False,
+        'error': 409,
+        'message': 'conflict',
+    }), 409
+
+
 @api.errorhandler(422)
 def unprocessable(error):
     return jsonify({
@@ -38,6 +50,18 @@ def unprocessable(error):
     }), 422
 
 
+@api.errorhandler(RateLimited)
+def too_many_requests(ex):
+    response = jsonify({
+        'success': False,
+        'error': 429,
+        'message': 'too many requests',
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(ex.retry_after))
+    return response
+
+
 @api.errorhandler(500)
 def internal_server_error(error):
     return jsonify({
@@ -45,3 +69,13 @@ def internal_server_error(error):
         'error': 500,
         'message': 'internal server error',
     }), 500
+
+
+@api.errorhandler(AuthError)
+def handle_auth_error(ex):
+    """
+    handles a AuthError exception
+    """
+    response = jsonify(ex.error)
+    response.status_code = ex.status_code
+    return response
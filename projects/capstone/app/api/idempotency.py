@@ -0,0 +1,134 @@
+"""
+idempotent write requests
+
+A POST or PATCH request with an 'Idempotency-Key' header is run once per
+token subject and key. Its response is kept for IDEMPOTENCY_TTL seconds
+and a retry with the same key gets the kept response again, with the
+header 'Idempotent-Replayed: true', instead of writing another row.
+
+A retry arriving while the first request is still running waits for
+its response rather than running concurrently. Reusing a key for a
+different request, another method, path or body, is a 422 error.
+
+Only responses returned by the view are kept. Requests which fail with
+an error, e.g. abort(404), may be retried with the same key. The
+responses are kept by each process on its own.
+"""
+import hashlib
+import threading
+from collections import namedtuple
+from functools import wraps
+from flask import current_app, request, abort
+from ..cache import TTLCache
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# a kept response and the fingerprint of the request it answered
+StoredResponse = namedtuple('StoredResponse', [
+    'fingerprint', 'status', 'headers', 'body'])
+
+
+class IdempotencyStore:
+    """
+    the kept responses by key and the keys of the requests in flight
+        - maxsize: the largest number of kept responses
+        - ttl: the seconds a response is kept
+        - wait_timeout: the seconds a retry waits for the request in flight
+    """
+
+    def __init__(self, maxsize=10000, ttl=24 * 60 * 60, wait_timeout=30):
+        self.responses = TTLCache(maxsize, ttl)
+        self.wait_timeout = wait_timeout
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """
+        the kept response of the key, or None once the caller owns the
+        key and has to run the request and call finish()
+        responds with a 409 error if the request in flight takes too long
+        """
+        while True:
+            with self._lock:
+                stored = self.responses.get(key)
+                if stored is not None:
+                    return stored
+                done = self._in_flight.get(key)
+                if done is None:
+                    self._in_flight[key] = threading.Event()
+                    return None
+            # the request in flight may fail, then the next waiter owns it
+            if not done.wait(self.wait_timeout):
+                abort(409)
+
+    def finish(self, key, stored=None):
+        """
+        keeps the response of the owned key, if any, and wakes the retries
+        """
+        with self._lock:
+            if stored is not None:
+                self.responses.put(key, stored)
+            self._in_flight.pop(key).set()
+
+
+def request_fingerprint():
+    """
+    the digest of the method, path and body of the request
+    """
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path}\n'.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def replay(stored):
+    response = current_app.response_class(
+        stored.body, status=stored.status, headers=stored.headers)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(f):
+    """
+    decorator of the methods of requires_auth, runs the request once per
+    subject and Idempotency-Key header. requests without the header are
+    run as usual
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        idempotency_key = request.headers.get(HEADER)
+        if idempotency_key is None:
+            return f(payload, *args, **kwargs)
+        if not 0 < len(idempotency_key) <= MAX_KEY_LENGTH:
+            abort(400)
+
+        store = current_app.extensions['idempotency_store']
+        key = (str(payload.get('sub')), idempotency_key)
+        fingerprint = request_fingerprint()
+        stored = store.begin(key)
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                abort(422)
+            return replay(stored)
+
+        stored = None
+        try:
+            response = current_app.make_response(f(payload, *args, **kwargs))
+            if response.status_code < 500 and not response.is_streamed:
+                stored = StoredResponse(
+                    fingerprint, response.status_code,
+                    [(name, value) for name, value in response.headers
+                     if name.lower() != 'content-length'],
+                    response.get_data())
+            return response
+        finally:
+            store.finish(key, stored)
+
+    return wrapper
+
+
+def init_idempotency_store(app):
+    app.extensions['idempotency_store'] = IdempotencyStore(
+        maxsize=app.config['IDEMPOTENCY_MAXSIZE'],
+        ttl=app.config['IDEMPOTENCY_TTL'])
@@ -0,0 +1,123 @@
+"""
+paginated list endpoints
+
+The list endpoints return their rows in pages ordered by the primary key.
+A page ends with the 'next_cursor', the key of its last row, which is
+passed back as 'after' to fetch the next page. Unlike an offset, the
+cursor is a seek on the primary key index, so late pages are as fast
+as the first one.
+
+The 'fields' parameter selects the returned fields (sparse fieldsets),
+e.g. fields=make,model. The key of the rows is always returned.
+
+Requests accepting 'application/x-ndjson' get all rows instead of a
+page, streamed as one json document per line while they are read from
+a server-side cursor, so the memory used does not grow with the rows.
+"""
+from flask import current_app, request, abort, stream_with_context
+from ..serialization import current_dumps
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+NDJSON = 'application/x-ndjson'
+# rows fetched from the cursor at a time while streaming
+STREAM_BATCH_SIZE = 1000
+
+
+def parse_arg(name, convert):
+    """
+    the query parameter converted by convert, or None if it is missing
+    responds with a 400 error if it cannot be converted
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError, KeyError):
+        abort(400)
+
+
+def parse_bool(value):
+    return {'true': True, 'false': False}[value.lower()]
+
+
+def parse_limit():
+    """
+    the page size of the 'limit' parameter, DEFAULT_LIMIT if it is missing
+    """
+    limit = parse_arg('limit', int)
+    if limit is None:
+        return DEFAULT_LIMIT
+    if not 0 < limit <= MAX_LIMIT:
+        abort(400)
+    return limit
+
+
+def parse_fields(fields, key):
+    """
+    the columns of the fields named by the 'fields' parameter, all fields
+    if it is missing. responds with a 400 error for unknown fields
+    Inputs:
+        fields: dictionary of the column of each field by name
+        key: the name of the key field, which is always selected
+    """
+    value = request.args.get('fields')
+    if not value:
+        return list(fields.values())
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    if any(name not in fields for name in names):
+        abort(400)
+    names = [key] + [name for name in names if name != key]
+    return [fields[name] for name in dict.fromkeys(names)]
+
+
+def keyset_page(query, key, columns, after=None, limit=DEFAULT_LIMIT):
+    """
+    one page of the query as dictionaries of the columns
+    Inputs:
+        key: the unique column the pages are ordered by
+        after: the key of the last row of the previous page
+    Returns:
+        the rows and the key of the last row if there may be further
+        rows, otherwise None
+    """
+    if after is not None:
+        query = query.filter(key > after)
+    # one more row than requested tells if there is a next page
+    rows = query.with_entities(*columns).order_by(key).limit(limit + 1)
+    rows = [row._asdict() for row in rows]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1][key.key]
+    return rows, None
+
+
+def wants_ndjson():
+    """
+    whether the client prefers NDJSON over a json page
+    """
+    return request.accept_mimetypes.best_match(
+        ['application/json', NDJSON]) == NDJSON
+
+
+def ndjson_response(query, key, columns, after=None):
+    """
+    streams all rows of the query after the key 'after' as NDJSON,
+    ordered by key. the rows are fetched STREAM_BATCH_SIZE at a time
+    and encoded as they are sent
+    """
+    if after is not None:
+        query = query.filter(key > after)
+    # yield_per also asks the driver for a server-side cursor
+    rows = query.with_entities(*columns).order_by(key) \
+        .yield_per(STREAM_BATCH_SIZE)
+    dumps = current_dumps()
+
+    def generate():
+        for row in rows:
+            yield dumps(row._asdict()) + b'\n'
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype=NDJSON)
@@ -0,0 +1,70 @@
+"""
+partial updates of PATCH requests
+
+A PATCH body may set any of the whitelisted fields of a model, checked
+against the types and lengths of their columns like the operations of
+a batch. The row is updated by a single UPDATE statement, without
+loading it first, which returns the updated row where the database
+supports UPDATE ... RETURNING (PostgreSQL). Other databases, such as
+SQLite, select the updated row in the same transaction afterwards.
+"""
+from flask import request, abort
+from .. import db
+from .batch import validate_fields
+
+
+def supports_returning():
+    """
+    whether the database of the session returns rows from UPDATE
+    """
+    return db.session.get_bind().dialect.implicit_returning
+
+
+class PartialUpdate:
+    """
+    the partial updates of a model
+    Inputs:
+        model: the model class, e.g. Vehicle
+        key: the name of its primary key, e.g. 'VIN'
+        fields: the names of the fields which may be set
+        columns: labeled expressions returned with the columns of the
+            updated row, e.g. Vehicle.bookings_count()
+    """
+
+    def __init__(self, model, key, fields, columns=()):
+        self.model = model
+        self.key = key
+        self.fields = fields
+        self.columns = columns
+
+    def parse(self):
+        """
+        the values of the fields set by the json body of the request
+        responds with a 400 error if the body sets no or unknown fields,
+        or values of the wrong type
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not body or \
+                validate_fields(self.model, self.fields, body):
+            abort(400)
+        return body
+
+    def execute(self, key, values, *conditions):
+        """
+        updates the row of the key with the values if it matches the
+        conditions, within the transaction of the session
+        Returns:
+            the updated row as a dictionary, None if no row was updated
+        """
+        table = self.model.__table__
+        where = db.and_(table.c[self.key] == key, *conditions)
+        statement = table.update().where(where).values(**values)
+        columns = list(table.c) + list(self.columns)
+        if supports_returning():
+            row = db.session.execute(statement.returning(*columns)).first()
+        elif db.session.execute(statement).rowcount:
+            row = db.session.execute(
+                db.select(columns).where(table.c[self.key] == key)).first()
+        else:
+            row = None
+        return dict(row) if row is not None else None
@@ -1,23 +1,112 @@
-from flask import jsonify, request, abort
+from flask import request, abort
+from sqlalchemy.exc import SQLAlchemyError
 from . import api
+from .. import db
 from ..auth.auth import requires_auth
+from ..rate_limit import rate_limited
+from .idempotency import idempotent
+from .batch import Batch
+from .bookings import parse_datetime
+from .partial_update import PartialUpdate
+from .listing import (keyset_page, ndjson_response, parse_arg, parse_bool,
+                      parse_fields, parse_limit, wants_ndjson)
 from ..models import Vehicle
+from ..serialization import json_response
+
+VEHICLE_COLUMNS = (Vehicle.VIN, Vehicle.make, Vehicle.model,
+                   Vehicle.model_year, Vehicle.fuel_type,
+                   Vehicle.standard_seat_number, Vehicle.automatic)
+VEHICLE_FIELDS = dict({column.key: column for column in VEHICLE_COLUMNS},
+                      bookings_count=Vehicle.bookings_count())
+VEHICLE_BATCH = Batch(Vehicle, 'VIN', ('make', 'model', 'model_year',
+                                       'fuel_type', 'standard_seat_number',
+                                       'automatic'), 'vehicles')
+VEHICLE_UPDATE = PartialUpdate(Vehicle, 'VIN', VEHICLE_BATCH.fields,
+                               (Vehicle.bookings_count(),))
 
 
 @api.route("/vehicles", methods=["GET"])
 def get_vehicles():
     """
     public endpoint GET /vehicles
-    contains the vehicle json data representation
+    contains the vehicle json data representation, one page ordered by VIN
+    query parameters, all optional:
+        after: the next_cursor of the previous page
+        limit: the number of vehicles of a page, at most 1000
+        fields: comma separated fields to return, the VIN is always returned
+        make, fuel_type: only vehicles of this make or fuel type
+        model_year_min, model_year_max: only vehicles of these model years
     Returns:
-        status code 200 and json {"success": True, "vehicles": vehicles} where vehicles is the list of vehicles
+        status code 200 and json {"success": True, "vehicles": vehicles, "next_cursor": cursor} where vehicles is the list of vehicles and cursor is null on the last page
         appropriate status code indicating reason for failure
     """
+    after = parse_arg('after', int)
+    limit = parse_limit()
+    columns = parse_fields(VEHICLE_FIELDS, 'VIN')
+    make = parse_arg('make', str)
+    fuel_type = parse_arg('fuel_type', str)
+    model_year_min = parse_arg('model_year_min', int)
+    model_year_max = parse_arg('model_year_max', int)
+
     try:
-        vehicles = [v.to_json() for v in Vehicle.query.all()]
-        return jsonify({
+        query = Vehicle.query
+        if make is not None:
+            query = query.filter(Vehicle.make == make)
+        if fuel_type is not None:
+            query = query.filter(Vehicle.fuel_type == fuel_type)
+        if model_year_min is not None:
+            query = query.filter(Vehicle.model_year >= model_year_min)
+        if model_year_max is not None:
+            query = query.filter(Vehicle.model_year <= model_year_max)
+        if wants_ndjson():
+            return ndjson_response(query, Vehicle.VIN, columns, after)
+        vehicles, next_cursor = keyset_page(query, Vehicle.VIN, columns,
+                                            after, limit)
+        return json_response({
             "success": True,
             "vehicles": vehicles,
+            "next_cursor": next_cursor,
+        })
+    except:
+        abort(500)
+
+
+@api.route("/vehicles/available", methods=["GET"])
+def get_available_vehicles():
+    """
+    public endpoint GET /vehicles/available
+    the vehicles which are not booked between start and end
+    query parameters:
+        start, end: ISO 8601 datetimes, required
+        seats: minimum number of seats, optional
+        automatic: 'true' or 'false', optional
+        after, limit, fields: paging and fields as in GET /vehicles
+    contains the vehicle json data representation without bookings_count
+    Returns:
+        status code 200 and json {"success": True, "vehicles": vehicles, "next_cursor": cursor} where vehicles is the list of available vehicles
+        appropriate status code indicating reason for failure
+    """
+    start = parse_arg('start', parse_datetime)
+    end = parse_arg('end', parse_datetime)
+    seats = parse_arg('seats', int)
+    automatic = parse_arg('automatic', parse_bool)
+    if start is None or end is None or start >= end:
+        abort(400)
+    after = parse_arg('after', int)
+    limit = parse_limit()
+    columns = parse_fields(
+        {column.key: column for column in VEHICLE_COLUMNS}, 'VIN')
+
+    try:
+        query = Vehicle.available(start, end, seats, automatic)
+        if wants_ndjson():
+            return ndjson_response(query, Vehicle.VIN, columns, after)
+        vehicles, next_cursor = keyset_page(query, Vehicle.VIN, columns,
+                                            after, limit)
+        return json_response({
+            "success": True,
+            "vehicles": vehicles,
+            "next_cursor": next_cursor,
         })
     except:
         abort(500)
@@ -35,7 +124,7 @@ def get_vehicle(id):
     """
     try:
         vehicle = Vehicle.query.get_or_404(id)
-        return jsonify({
+        return json_response({
             "success": True,
             "vehicles": [vehicle.to_json()],
         })
@@ -45,7 +134,9 @@ def get_vehicle(id):
 
 @api.route("/vehicles", methods=["POST"])
 @requires_auth('post:vehicles')
-def post_vehicle():
+@rate_limited
+@idempotent
+def post_vehicle(payload):
     """
     endpoint POST /vehicles
     creates a new row in the vehicles table
@@ -67,7 +158,7 @@ def post_vehicle():
     )
     try:
         vehicle.insert()
-        return jsonify({
+        return json_response({
             'success': True,
             'vehicle_vin': vehicle.VIN,
         })
@@ -75,8 +166,28 @@ def post_vehicle():
         abort(422)
 
 
+@api.route("/vehicles/batch", methods=["POST"])
+@requires_auth()
+@rate_limited
+@idempotent
+def post_vehicles_batch(payload):
+    """
+    endpoint POST /vehicles/batch
+    creates, updates and deletes vehicles in chunked transactions
+        {"operations": [{"op": "create" | "update" | "delete", "VIN": ..., ...}]}
+    requires 'post:vehicles', 'patch:vehicles' and 'delete:vehicles' for
+    the kinds of operations in the batch, checked once
+    Returns:
+        status code 200 and json {"success": True, "results": results, "stats": stats} where results has the result of each operation and stats the throughput
+        appropriate status code indicating reason for failure
+    """
+    return VEHICLE_BATCH.response(payload)
+
+
 @api.route('/vehicles/<int:id>', methods=['PATCH'])
 @requires_auth('patch:vehicles')
+@rate_limited
+@idempotent
 def patch_vehicle(payload, id):
     """
     endpoint PATCH /vehicles/<id>, where <id> is the existing model id
@@ -84,36 +195,33 @@ def patch_vehicle(payload, id):
     updates the corresponding row for <id>
     requires the 'patch:vehicles' permission
     contains the vehicle json data representation
+    body: the fields to set, any of make, model, model_year, fuel_type,
+        standard_seat_number and automatic. responds with a 400 error
+        for other fields or values of the wrong type
     Returns:
-        status code 200 and json {"success": True, "vehicles": vehicle} where vehicle an array containing only the updated vehicle
+        status code 200 and json {"success": True, "vehicle_vin": vin, "vehicles": vehicle} where vehicle an array containing only the updated vehicle
         appropriate status code indicating reason for failure
     """
+    values = VEHICLE_UPDATE.parse()
+    vehicle = VEHICLE_UPDATE.execute(id, values)
+    if vehicle is None:
+        db.session.rollback()
+        abort(404)
     try:
-        body = request.get_json()
-        vehicle = Vehicle.query.get_or_404(id)
-        if 'make' in body:
-            vehicle.make = json.dumps(body.get('make'))
-        if 'model' in body:
-            vehicle.model = body.get('model')
-        if 'model_year' in body:
-            vehicle.model_year = body.get('model_year')
-        if 'fuel_type' in body:
-            vehicle.fuel_type = json.dumps(body.get('fuel_type'))
-        if 'standard_seat_number' in body:
-            vehicle.standard_seat_number = body.get('standard_seat_number')
-        if 'automatic' in body:
-            vehicle.automatic = body.get('automatic')
-        vehicle.update()
-        return jsonify({
-            'success': True,
-            'vehicle_vin': vehicle.VIN,
-        })
-    except:
-        abort(500)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+    return json_response({
+        'success': True,
+        'vehicle_vin': vehicle['VIN'],
+        'vehicles': [vehicle],
+    })
 
 
 @api.route('/vehicles/<int:id>', methods=['DELETE'])
 @requires_auth('delete:vehicles')
+@rate_limited
 def delete_vehicle(payload, id):
     """
     endpoint DELETE /vehicles/<id>, where <id> is the existing model id
@@ -127,7 +235,7 @@ def delete_vehicle(payload, id):
     try:
         vehicle = Vehicle.query.get_or_404(id)
         vehicle.delete()
-        return jsonify({
+        return json_response({
             'success': True,
             'vehicle_vin': id,
         })
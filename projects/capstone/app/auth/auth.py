@@ -1,13 +1,19 @@
 import os
-import json
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from .jwks import JWKSKeyStore
+from .permissions import PermissionSet
+from .token_cache import VerifiedTokenCache
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+# may point to a local file (file://...) for testing
+JWKS_URL = os.environ.get('JWKS_URL') or \
+    f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+token_cache = VerifiedTokenCache()
 
 
 class AuthError(Exception):
@@ -69,22 +75,28 @@ def check_permissions(permission, payload):
     """
     checks if the decoded JWT has required permission
     Inputs:
-        permission: string permission (i.e. 'post:vehicle')
-        payload: decoded jwt payload
+        permission: string permission (i.e. 'post:vehicle'), or a list of
+            permissions which are all required. wildcard and hierarchical
+            scopes of the token such as '*:drinks', 'post:*' or
+            'drinks:*' grant the matching permissions
+        payload: decoded jwt payload, or its precomputed PermissionSet
     Raises:
         AuthError: if
             - permissions are not included in the payload 
-            - the requested permission string is not in the payload permissions array
+            - a requested permission is not granted by the payload permissions
     Return:
         True otherwise 
     """
-    if 'permissions' not in payload:
+    permissions = payload if isinstance(payload, PermissionSet) \
+        else PermissionSet.from_payload(payload)
+    if permissions is None:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    required = [permission] if isinstance(permission, str) else permission
+    if permissions.missing(required):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -102,8 +114,8 @@ def verify_decode_jwt(token):
     Returns:
         decoded payload
     """
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # jose is imported with the first token, not when the app starts
+    from jose import jwt
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
 
@@ -113,15 +125,22 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    try:
+        key = jwks_store.get_key(unverified_header['kid'])
+    except (OSError, ValueError):
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
 
     if rsa_key:
         try:
@@ -155,10 +174,20 @@ def verify_decode_jwt(token):
     }, 400)
 
 
-def requires_auth(permission=''):
+def current_permissions():
+    """
+    the precomputed PermissionSet of the token verified by requires_auth
+    for the current request, for permissions which the view only knows
+    once it has read the request
+    """
+    return _request_ctx_stack.top.permissions
+
+
+def requires_auth(*permissions):
     """
     Inputs:
-        permission: string permission (i.e. 'post:vehicle')
+        permissions: string permissions (i.e. 'post:vehicle'), all of them are
+            required. without permissions only the token is verified
     Returns:
         decorator which passes the decoded payload to the decorated method
     """
@@ -167,11 +196,14 @@ def requires_auth(permission=''):
         def wrapper(*args, **kwargs):
             # get the token
             token = get_token_auth_header()
-            # decode the jwt
-            payload = verify_decode_jwt(token)
-            # validate claims and check the requested permission
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            # decode the jwt, unless it was verified before
+            verified = token_cache.verify(token, verify_decode_jwt)
+            # kept for checks of the view, see current_permissions()
+            _request_ctx_stack.top.permissions = verified.permissions
+            # validate claims and check the requested permissions
+            if permissions:
+                check_permissions(permissions, verified.permissions)
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
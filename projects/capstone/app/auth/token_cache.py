@@ -0,0 +1,110 @@
+"""
+verified token cache
+
+Clients reuse the same bearer token for hours, so the payload of a
+verified token is kept until the token expires instead of checking
+its RSA signature again on every request.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from .permissions import PermissionSet
+
+DEFAULT_MAXSIZE = 1024
+
+# the payload of a verified token and its precomputed permission set
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions'])
+
+
+class VerifiedTokenCache:
+    """
+    bounded LRU of verified token payloads
+        - keyed by the SHA-256 digest of the token, the tokens themselves
+          are not kept in memory
+        - an entry expires at the 'exp' claim of its token, tokens
+          without 'exp' are not cached
+        - counts hits and misses and the time spent verifying tokens
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.verification_seconds = 0.0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        """
+        the cached VerifiedToken of the token, or None
+        """
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, verified = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return verified
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        """
+        caches the verified payload until the token expires
+        Returns:
+            the VerifiedToken of the payload
+        """
+        verified = VerifiedToken(payload, PermissionSet.from_payload(payload))
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)):
+            return verified
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, verified)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return verified
+
+    def verify(self, token, verify_decode_jwt):
+        """
+        the VerifiedToken of the token, from the cache or verified by
+        verify_decode_jwt. failed verifications are not cached
+        """
+        verified = self.get(token)
+        if verified is None:
+            start = time.perf_counter()
+            try:
+                payload = verify_decode_jwt(token)
+            finally:
+                self.verification_seconds += time.perf_counter() - start
+            verified = self.put(token, payload)
+        return verified
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        metrics of the cache
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'verification_seconds': self.verification_seconds,
+            'average_verification_ms':
+                1000 * self.verification_seconds / self.misses
+                if self.misses else None,
+        }
@@ -0,0 +1,214 @@
+"""
+write-behind booking queue
+
+With BOOKING_QUEUE set to a file path, POST /bookings validates the
+booking, stores it as a ticket in a local SQLite file and answers 202
+at once. Worker threads claim the pending tickets in batches, create
+the bookings with their overlap checks and record the outcome of each
+ticket, which clients poll with GET /bookings/tickets/<ticket>.
+
+Tickets are committed to the file before the request is answered, so
+they survive a restart. Several processes may share the file, a batch
+is claimed in an immediate transaction and records the queue which
+claimed it. A claim expires after claim_timeout seconds, then the
+tickets of a worker which died are claimed again by the next worker;
+a queue only completes or releases the tickets it still owns.
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    claimed_by TEXT,
+    claimed_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_tickets_status_created_at
+    ON tickets (status, created_at);
+"""
+# columns added to the tickets table after it was first released
+ADDED_COLUMNS = {
+    'claimed_by': 'TEXT',
+    'claimed_at': 'REAL',
+}
+
+
+class BookingQueue:
+    """
+    durable queue of tickets in a SQLite file
+        - path: the file of the queue
+        - batch_size: the number of tickets a worker claims at a time
+        - poll_interval: the seconds an idle worker waits for tickets
+        - claim_timeout: the seconds after which the claimed tickets of
+          a worker, which is expected to have died, are claimed again.
+          it has to be longer than processing a batch takes
+    """
+
+    def __init__(self, path, batch_size=100, poll_interval=0.5,
+                 claim_timeout=300):
+        self.path = path
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        # the owner of the claims of this queue
+        self.id = uuid.uuid4().hex
+        self._local = threading.local()
+        self._stopping = threading.Event()
+        self._workers = []
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+        columns = {row[1] for row in
+                   connection.execute('PRAGMA table_info(tickets)')}
+        for name, column_type in ADDED_COLUMNS.items():
+            if name not in columns:
+                connection.execute(
+                    f'ALTER TABLE tickets ADD COLUMN {name} {column_type}')
+
+    def _connection(self):
+        """
+        the connection of the current thread, in autocommit mode
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def enqueue(self, payload):
+        """
+        stores a pending ticket of the payload
+        Returns:
+            the id of the ticket
+        """
+        ticket = uuid.uuid4().hex
+        now = time.time()
+        self._connection().execute(
+            'INSERT INTO tickets (id, payload, status, created_at, '
+            'updated_at) VALUES (?, ?, ?, ?, ?)',
+            (ticket, json.dumps(payload), PENDING, now, now))
+        return ticket
+
+    def claim(self, limit=None):
+        """
+        marks the oldest pending tickets, and the tickets whose claim
+        expired, as processing by this queue
+        Returns:
+            the claimed (ticket, payload) pairs
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            rows = connection.execute(
+                'SELECT id, payload FROM tickets WHERE status = ? OR '
+                '(status = ? AND (claimed_at IS NULL OR claimed_at < ?)) '
+                'ORDER BY created_at LIMIT ?',
+                (PENDING, PROCESSING, now - self.claim_timeout,
+                 limit or self.batch_size)).fetchall()
+            connection.executemany(
+                'UPDATE tickets SET status = ?, claimed_by = ?, '
+                'claimed_at = ?, updated_at = ? WHERE id = ?',
+                [(PROCESSING, self.id, now, now, ticket)
+                 for ticket, _ in rows])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return [(ticket, json.loads(payload)) for ticket, payload in rows]
+
+    def complete(self, results):
+        """
+        records the outcome of the processed tickets this queue owns
+        Inputs:
+            results: dictionary of the result of each ticket, each result
+                has a 'status' other than pending or processing
+        """
+        now = time.time()
+        self._connection().executemany(
+            'UPDATE tickets SET status = ?, result = ?, updated_at = ? '
+            'WHERE id = ? AND status = ? AND claimed_by = ?',
+            [(result['status'], json.dumps(result), now, ticket,
+              PROCESSING, self.id)
+             for ticket, result in results.items()])
+
+    def status(self, ticket):
+        """
+        the status and result of the ticket, or None if there is no such
+        ticket
+        """
+        row = self._connection().execute(
+            'SELECT status, result FROM tickets WHERE id = ?',
+            (ticket,)).fetchone()
+        if row is None:
+            return None
+        status, result = row
+        return dict(json.loads(result) if result else {}, status=status)
+
+    def process(self, handler):
+        """
+        claims one batch and completes it with handler, which takes the
+        list of (ticket, payload) pairs and returns the results by ticket
+        Returns:
+            the number of processed tickets
+        """
+        batch = self.claim()
+        if batch:
+            try:
+                results = handler(batch)
+            except BaseException:
+                self.release([ticket for ticket, _ in batch])
+                raise
+            self.complete(results)
+        return len(batch)
+
+    def release(self, tickets):
+        """
+        makes the claimed tickets this queue owns pending again
+        """
+        self._connection().executemany(
+            'UPDATE tickets SET status = ?, claimed_by = NULL, '
+            'claimed_at = NULL, updated_at = ? '
+            'WHERE id = ? AND status = ? AND claimed_by = ?',
+            [(PENDING, time.time(), ticket, PROCESSING, self.id)
+             for ticket in tickets])
+
+    def start(self, app, handler, workers=2):
+        """
+        starts worker threads processing the queue with handler in an
+        application context of app
+        """
+        def run():
+            while not self._stopping.is_set():
+                try:
+                    with app.app_context():
+                        processed = self.process(handler)
+                except Exception:
+                    app.logger.exception('Processing booking tickets failed')
+                    processed = 0
+                if not processed:
+                    self._stopping.wait(self.poll_interval)
+
+        for _ in range(workers):
+            worker = threading.Thread(target=run, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
@@ -0,0 +1,73 @@
+"""
+bounded time-to-live cache
+
+A thread-safe in-memory mapping whose entries expire ttl seconds after
+they were stored. When it holds maxsize entries, storing another one
+evicts the least recently used entry.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    bounded LRU mapping with expiring entries
+        - maxsize: the largest number of entries
+        - ttl: the seconds an entry is kept
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        the value of the key, or default if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        stores the value of the key for ttl seconds
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        removes the key
+        Returns:
+            its value, or default if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, _MISSING)
+        if entry is _MISSING or time.monotonic() >= entry[0]:
+            return default
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,11 +1,27 @@
 import os
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
 from . import db
+from .cache import TTLCache
+
+# most emails of a client lookup, so that it is a single IN query
+MAX_EMAIL_LOOKUP = 500
+_UNCACHED = object()
 
 
 class Vehicle(db.Model):
     __tablename__ = "vehicles"
+    __table_args__ = (
+        # availability search by gearbox and seats
+        db.Index("ix_vehicles_automatic_seats",
+                 "automatic", "standard_seat_number"),
+        # filters of the vehicle list, in the order of its pages
+        db.Index("ix_vehicles_make_VIN", "make", "VIN"),
+        db.Index("ix_vehicles_fuel_type_VIN", "fuel_type", "VIN"),
+        db.Index("ix_vehicles_model_year_VIN", "model_year", "VIN"),
+    )
 
     VIN = db.Column(db.Integer, primary_key=True)
     make = db.Column(db.String(64))
@@ -16,7 +32,39 @@ class Vehicle(db.Model):
     automatic = db.Column(db.Boolean)
     bookings = db.relationship("Booking", backref="vehicles")
 
-    def to_json(self):
+    @staticmethod
+    def bookings_count():
+        """
+        column of the number of bookings of each vehicle, a subquery
+        correlated to the vehicles of the enclosing query which counts
+        on the vehicle_VIN index of the bookings
+        """
+        return Booking.count_of(Booking.vehicle_VIN == Vehicle.VIN)
+
+    @staticmethod
+    def available(start, end, seats=None, automatic=None):
+        """
+        query of the vehicles without a booking overlapping [start, end),
+        with at least the given number of seats and the given gearbox.
+        each vehicle is checked by an index seek on the bookings, however
+        many bookings there are
+        """
+        query = Vehicle.query.filter(~Booking.query.filter(
+            Booking.overlaps(Vehicle.VIN, start, end)).exists())
+        if seats is not None:
+            query = query.filter(Vehicle.standard_seat_number >= seats)
+        if automatic is not None:
+            query = query.filter(Vehicle.automatic == automatic)
+        return query
+
+    def to_json(self, bookings_count=None):
+        """
+        bookings_count: the number of bookings if it is already known,
+            e.g. from bookings_count(), otherwise they are counted
+        """
+        if bookings_count is None:
+            bookings_count = Booking.query.filter_by(
+                vehicle_VIN=self.VIN).count()
         return {
             "VIN": self.VIN,
             "make": self.make,
@@ -25,7 +73,7 @@ class Vehicle(db.Model):
             "fuel_type": self.fuel_type,
             "standard_seat_number": self.standard_seat_number,
             "automatic": self.automatic,
-            "bookings_count": self.bookings.count(),
+            "bookings_count": bookings_count,
         }
 
     def insert(self):
@@ -45,21 +93,77 @@ class Vehicle(db.Model):
 
 class Client(db.Model):
     __tablename__ = "clients"
+    __table_args__ = (
+        # surname filter of the client list, in the order of its pages
+        db.Index("ix_clients_surname_id", "surname", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     forename = db.Column(db.String(64))
     surname = db.Column(db.String(64))
-    email = db.Column(db.String(64), unique=True, index=True)
+    # the replaced email is loaded before it changes, to be removed
+    # from the email lookup cache
+    email = db.column_property(
+        db.Column(db.String(64), unique=True, index=True),
+        active_history=True)
     bookings = db.relationship("Booking", backref="clients")
 
-    def to_json(self):
+    # the lookup fields of the clients by email, None for unknown emails
+    email_cache = TTLCache(maxsize=4096, ttl=60)
+
+    @classmethod
+    def lookup(cls, emails):
+        """
+        the id, forename, surname and email of the clients with the emails
+        by email, read through email_cache. the uncached emails are
+        looked up on the email index with a single IN query
+        Inputs:
+            emails: at most MAX_EMAIL_LOOKUP emails
+        """
+        found = {}
+        uncached = []
+        for email in dict.fromkeys(emails):
+            client = cls.email_cache.get(email, _UNCACHED)
+            if client is _UNCACHED:
+                uncached.append(email)
+            elif client is not None:
+                found[email] = client
+        if not uncached:
+            return found
+
+        rows = db.session.query(cls.id, cls.forename, cls.surname,
+                                cls.email).filter(cls.email.in_(uncached))
+        for row in rows:
+            found[row.email] = row._asdict()
+            cls.email_cache.put(row.email, found[row.email])
+        for email in uncached:
+            if email not in found:
+                cls.email_cache.put(email, None)
+        return found
+
+    @staticmethod
+    def bookings_count():
+        """
+        column of the number of bookings of each client, a subquery
+        correlated to the clients of the enclosing query which counts
+        on the client_id index of the bookings
+        """
+        return Booking.count_of(Booking.client_id == Client.id)
+
+    def to_json(self, bookings_count=None):
+        """
+        bookings_count: the number of bookings if it is already known,
+            e.g. from bookings_count(), otherwise they are counted
+        """
+        if bookings_count is None:
+            bookings_count = Booking.query.filter_by(
+                client_id=self.id).count()
         return {
             "id": self.id,
-            "client_uuid": self.client_uuid,
             "forename": self.forename,
             "surname": self.surname,
             "email": self.email,
-            "bookings_count": self.bookings.count(),
+            "bookings_count": bookings_count,
         }
 
     def insert(self):
@@ -79,15 +183,80 @@ class Client(db.Model):
 
 class Booking(db.Model):
     __tablename__ = "bookings"
+    __table_args__ = (
+        # overlap checks seek the bookings of one vehicle by start time
+        db.Index("ix_bookings_vehicle_period",
+                 "vehicle_VIN", "start_datetime", "end_datetime"),
+        # filters of the booking list, in the order of its pages
+        db.Index("ix_bookings_client_id_id", "client_id", "id"),
+        db.Index("ix_bookings_start_datetime", "start_datetime"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    vehicle_VIN = db.Column(db.Integer, db.ForeignKey("vehicles.VIN"))
+    # the replaced values of the booked vehicle and period are loaded
+    # before they change, to be removed from the daily usage rollup
+    vehicle_VIN = db.column_property(
+        db.Column(db.Integer, db.ForeignKey("vehicles.VIN")),
+        active_history=True)
     client_id = db.Column(db.Integer, db.ForeignKey("clients.id"))
-    start_datetime = db.Column(db.DateTime, nullable=False)
-    end_datetime = db.Column(db.DateTime, nullable=False)
+    start_datetime = db.column_property(
+        db.Column(db.DateTime, nullable=False), active_history=True)
+    end_datetime = db.column_property(
+        db.Column(db.DateTime, nullable=False), active_history=True)
     vehicle = db.relationship("Vehicle")
     client = db.relationship("Client")
 
+    @staticmethod
+    def count_of(condition):
+        """
+        scalar subquery labeled 'bookings_count' of the number of bookings
+        matching the condition
+        """
+        return db.select([db.func.count()]).where(condition) \
+            .label("bookings_count")
+
+    @staticmethod
+    def overlaps(vehicle_VIN, start, end):
+        """
+        clause of the bookings of the vehicle which overlap [start, end),
+        vehicle_VIN may be a value or a column of an enclosing query
+        """
+        return db.and_(
+            Booking.vehicle_VIN == vehicle_VIN,
+            Booking.start_datetime < end,
+            Booking.end_datetime > start,
+        )
+
+    @staticmethod
+    def is_vehicle_booked(vehicle_VIN, start, end, exclude_id=None):
+        """
+        whether a booking of the vehicle other than exclude_id overlaps
+        [start, end), answered by a single indexed EXISTS query
+        """
+        query = Booking.query.filter(
+            Booking.overlaps(vehicle_VIN, start, end))
+        if exclude_id is not None:
+            query = query.filter(Booking.id != exclude_id)
+        return db.session.query(query.exists()).scalar()
+
+    @staticmethod
+    def is_vehicle_free(vehicle_VIN, start, end, exclude_id=None):
+        """
+        NOT EXISTS clause of the bookings of the vehicle other than
+        exclude_id which overlap [start, end), on an alias of the bookings
+        so that it may be the condition of an INSERT or UPDATE of the
+        bookings
+        """
+        other = Booking.__table__.alias("other_bookings")
+        overlapping = [
+            other.c.vehicle_VIN == vehicle_VIN,
+            other.c.start_datetime < end,
+            other.c.end_datetime > start,
+        ]
+        if exclude_id is not None:
+            overlapping.append(other.c.id != exclude_id)
+        return ~db.exists().where(db.and_(*overlapping))
+
     def to_json(self):
         return {
             "id": self.id,
@@ -110,3 +279,141 @@ class Booking(db.Model):
 
     def __repr__(self):
         return json.dumps(self.to_json())
+
+
+class VehicleDailyUsage(db.Model):
+    """
+    daily rollup of the booked time of each vehicle, kept up to date by
+    the Booking mapper events below, so that utilization reports do not
+    read the bookings
+    """
+    __tablename__ = "vehicle_daily_usage"
+
+    vehicle_VIN = db.Column(
+        db.Integer, db.ForeignKey("vehicles.VIN", ondelete="CASCADE"),
+        primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    booked_seconds = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def split_by_day(start, end):
+        """
+        (day, seconds) of the part of [start, end) on each day it covers
+        """
+        parts = []
+        while start < end:
+            midnight = datetime.combine(start.date() + timedelta(days=1),
+                                        datetime.min.time())
+            part_end = min(end, midnight)
+            parts.append((start.date(),
+                          int((part_end - start).total_seconds())))
+            start = part_end
+        return parts
+
+    @staticmethod
+    def add(connection, vehicle_VIN, start, end, sign=1):
+        """
+        adds (sign=1) or removes (sign=-1) a booked interval of the vehicle
+        to its daily rows, within the transaction of the connection
+        """
+        if vehicle_VIN is None or start is None or end is None:
+            return
+        table = VehicleDailyUsage.__table__
+        for day, seconds in VehicleDailyUsage.split_by_day(start, end):
+            key = db.and_(table.c.vehicle_VIN == vehicle_VIN,
+                          table.c.day == day)
+            updated = connection.execute(table.update().where(key).values(
+                booked_seconds=table.c.booked_seconds + sign * seconds))
+            if updated.rowcount == 0 and sign > 0:
+                connection.execute(table.insert().values(
+                    vehicle_VIN=vehicle_VIN, day=day,
+                    booked_seconds=seconds))
+
+    @staticmethod
+    def rebuild():
+        """
+        recomputes all rows from the bookings, e.g. after the table was
+        created for existing bookings
+        """
+        VehicleDailyUsage.query.delete()
+        connection = db.session.connection()
+        bookings = db.session.query(
+            Booking.vehicle_VIN, Booking.start_datetime,
+            Booking.end_datetime).yield_per(1000)
+        for vehicle_VIN, start, end in bookings:
+            VehicleDailyUsage.add(connection, vehicle_VIN, start, end)
+        db.session.commit()
+
+
+def _old_value(booking, key):
+    history = inspect(booking).attrs[key].history
+    return history.deleted[0] if history.deleted else getattr(booking, key)
+
+
+@event.listens_for(Booking, "after_insert")
+def _add_booking_usage(mapper, connection, booking):
+    VehicleDailyUsage.add(connection, booking.vehicle_VIN,
+                          booking.start_datetime, booking.end_datetime)
+
+
+@event.listens_for(Booking, "after_update")
+def _update_booking_usage(mapper, connection, booking):
+    keys = ("vehicle_VIN", "start_datetime", "end_datetime")
+    state = inspect(booking)
+    if not any(state.attrs[key].history.has_changes() for key in keys):
+        return
+    VehicleDailyUsage.add(connection, *[_old_value(booking, key)
+                                        for key in keys], sign=-1)
+    VehicleDailyUsage.add(connection, booking.vehicle_VIN,
+                          booking.start_datetime, booking.end_datetime)
+
+
+@event.listens_for(Booking, "after_delete")
+def _remove_booking_usage(mapper, connection, booking):
+    VehicleDailyUsage.add(connection, *[_old_value(booking, key) for key in
+                                        ("vehicle_VIN", "start_datetime",
+                                         "end_datetime")], sign=-1)
+
+
+def _forget_client_emails(client):
+    """
+    removes the current and replaced emails of the client from the
+    lookup cache now and again once the session commits, so that a
+    lookup running meanwhile cannot keep the old client
+    """
+    history = inspect(client).attrs.email.history
+    emails = {client.email, *(history.deleted or ())} - {None}
+    for email in emails:
+        Client.email_cache.pop(email)
+    session = object_session(client)
+    if session is not None:
+        session.info.setdefault("client_emails", set()).update(emails)
+
+
+@event.listens_for(Client, "after_insert")
+def _forget_inserted_client(mapper, connection, client):
+    _forget_client_emails(client)
+
+
+@event.listens_for(Client, "after_update")
+def _forget_updated_client(mapper, connection, client):
+    state = inspect(client)
+    if any(state.attrs[key].history.has_changes()
+           for key in ("forename", "surname", "email")):
+        _forget_client_emails(client)
+
+
+@event.listens_for(Client, "after_delete")
+def _forget_deleted_client(mapper, connection, client):
+    _forget_client_emails(client)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_committed_client_emails(session):
+    for email in session.info.pop("client_emails", ()):
+        Client.email_cache.pop(email)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_client_emails(session, previous_transaction):
+    session.info.pop("client_emails", None)
@@ -0,0 +1,46 @@
+"""
+import time profile
+
+Runs a statement, by default the app factory, in a fresh interpreter
+with '-X importtime', which reports the time spent importing each
+module, and parses the report.
+"""
+import os
+import re
+import subprocess
+import sys
+from collections import namedtuple
+
+# import time: self [us] | cumulative | imported package
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', re.M)
+
+Import = namedtuple('Import', ['module', 'self_us', 'cumulative_us',
+                               'depth'])
+
+
+def parse_importtime(report):
+    """
+    the Import of each module of a '-X importtime' report
+    """
+    return [Import(module, int(self_us), int(cumulative_us),
+                   len(indent) // 2)
+            for self_us, cumulative_us, indent, module
+            in LINE.findall(report)]
+
+
+def profile_imports(statement, cwd=None):
+    """
+    runs the statement in a new interpreter with '-X importtime'
+    Raises:
+        RuntimeError: if the statement fails
+    Returns:
+        the Import of each module it imported
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=cwd or os.getcwd(), env=os.environ.copy(),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return parse_importtime(result.stderr)
@@ -0,0 +1,187 @@
+"""
+token bucket rate limiting of the write endpoints
+
+Every token subject ('sub' claim) has a bucket of up to 'burst' request
+tokens which refills at 'rate' tokens per second. A write request takes
+one token, a request finding the bucket empty is answered with 429 Too
+Many Requests and a Retry-After header.
+
+The buckets are kept by a backend:
+    - MemoryBackend keeps them in the process, each worker process
+      limits on its own
+    - SQLiteBackend keeps them in a SQLite file, which the worker
+      processes of a host share
+Any object with the take() method of the backends can be used instead,
+e.g. one keeping the buckets in a shared cache server.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app
+
+DEFAULT_MAXSIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class RateLimited(Exception):
+    """
+    RateLimited Exception
+    raised when the bucket of the subject is empty
+    """
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+def refill(tokens, updated_at, now, rate, burst):
+    """
+    the tokens of a bucket which had tokens at updated_at
+    """
+    return min(burst, tokens + (now - updated_at) * rate)
+
+
+def take_token(tokens, rate):
+    """
+    Returns:
+        the tokens left after taking one and the seconds to wait for a
+        token, 0 if one was taken
+    """
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBackend:
+    """
+    the buckets of this process, at most maxsize of them. a bucket which
+    was not used for long is full again, so the least recently used
+    buckets are dropped
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """
+        takes a token from the bucket of the key
+        Returns:
+            the seconds to wait for a token, 0 if one was taken
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens, wait = take_token(
+                refill(tokens, updated_at, now, rate, burst), rate)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteBackend:
+    """
+    the buckets in a SQLite file shared by the processes of a host, a
+    token is taken in an immediate transaction
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        """
+        the connection of the current thread, in autocommit mode
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        """
+        takes a token from the bucket of the key
+        Returns:
+            the seconds to wait for a token, 0 if one was taken
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated_at FROM buckets WHERE key = ?',
+                (key,)).fetchone()
+            tokens, updated_at = row or (burst, now)
+            tokens, wait = take_token(
+                refill(tokens, updated_at, now, rate, burst), rate)
+            connection.execute(
+                'INSERT OR REPLACE INTO buckets (key, tokens, updated_at) '
+                'VALUES (?, ?, ?)', (key, tokens, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter:
+    """
+    token buckets of rate tokens per second and up to burst tokens
+    """
+
+    def __init__(self, rate, burst, backend=None):
+        self.rate = rate
+        self.burst = burst
+        self.backend = backend or MemoryBackend()
+
+    def check(self, key):
+        """
+        takes a token for the key
+        Raises:
+            RateLimited: if the bucket of the key is empty
+        """
+        wait = self.backend.take(key, self.rate, self.burst)
+        if wait:
+            raise RateLimited(wait)
+
+
+def init_rate_limiter(app):
+    """
+    sets up the rate limiter of the app if RATE_LIMIT_PER_SECOND is set,
+    with the buckets in the RATE_LIMIT_STORE file if it is set
+    """
+    store = app.config.get('RATE_LIMIT_STORE')
+    app.extensions['rate_limiter'] = RateLimiter(
+        app.config['RATE_LIMIT_PER_SECOND'], app.config['RATE_LIMIT_BURST'],
+        SQLiteBackend(store) if store else MemoryBackend())
+
+
+def rate_limited(f):
+    """
+    decorator of the methods of requires_auth, limits the requests of the
+    subject of the payload if the app has a rate limiter
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        limiter = current_app.extensions.get('rate_limiter')
+        if limiter is not None:
+            limiter.check(str(payload.get('sub')))
+        return f(payload, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,79 @@
+"""
+JSON encoding of the API responses
+
+The encoder is chosen with the JSON_BACKEND setting of the app:
+'orjson', 'stdlib' or 'auto' (the default), which uses orjson when it is
+installed and falls back to the standard library otherwise.
+"""
+import json
+from datetime import date, datetime
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    """
+    encodes the values the json module does not handle
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} '
+                    'is not JSON serializable')
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, default=_default, separators=(',', ':')).encode()
+
+
+def orjson_dumps(obj):
+    # dictionaries keyed by ids have integer keys
+    return orjson.dumps(obj, default=_default,
+                        option=orjson.OPT_NON_STR_KEYS)
+
+
+BACKENDS = {
+    'stdlib': stdlib_dumps,
+}
+if orjson is not None:
+    BACKENDS['orjson'] = orjson_dumps
+
+
+def get_dumps(backend='auto'):
+    """
+    the encoder for the given backend name
+    """
+    if backend == 'auto':
+        backend = 'orjson' if orjson is not None else 'stdlib'
+    try:
+        return BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f'JSON backend {backend!r} is not available')
+
+
+def current_dumps():
+    """
+    the encoder configured by the JSON_BACKEND setting of the app
+    """
+    return get_dumps(current_app.config.get('JSON_BACKEND', 'auto'))
+
+
+def json_response(payload, status=200):
+    """
+    drop-in replacement for jsonify using the configured encoder
+    """
+    return current_app.response_class(
+        current_dumps()(payload), status=status, mimetype='application/json')
+
+
+def query_rows(query, *columns):
+    """
+    fast path for list endpoints: selects only the given columns and
+    builds the dictionaries straight from the row tuples, keyed by the
+    column names, without loading an ORM object per row
+    """
+    keys = [column.key for column in columns]
+    return [dict(zip(keys, row)) for row in query.with_entities(*columns)]
@@ -1,8 +1,44 @@
 import os
 import sys
 import click
-from flask_migrate import Migrate, upgrade
 from app import create_app, db
 from app.models import Vehicle, Client, Booking
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
+
+if os.environ.get('FLASK_RUN_FROM_CLI'):
+    # the 'flask db' commands, Flask-Migrate and alembic are not
+    # imported by servers such as gunicorn
+    from flask_migrate import Migrate
+    Migrate(app, db)
+
+
+@app.cli.command('rebuild-usage')
+def rebuild_usage():
+    """Recompute the daily vehicle usage rollup from the bookings."""
+    from app.models import VehicleDailyUsage
+    VehicleDailyUsage.rebuild()
+    click.echo(f'{VehicleDailyUsage.query.count()} daily usage rows.')
+
+
+@app.cli.command('profile-imports')
+@click.option('--statement', help='Python statement to profile, '
+              'by default importing and creating the app.')
+@click.option('--top', default=20, help='Number of modules to list.')
+def profile_imports_command(statement, top):
+    """Report the slowest imports of the app with python -X importtime."""
+    from app.profiling import profile_imports
+    config_name = os.getenv('FLASK_CONFIG') or 'default'
+    statement = statement or \
+        f'from app import create_app; create_app({config_name!r})'
+    imports = profile_imports(statement,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    total_us = sum(i.self_us for i in imports)
+    click.echo(f'{statement}')
+    click.echo(f'{total_us / 1000:.1f} ms importing {len(imports)} modules\n')
+    click.echo(f'{"cumulative":>12} {"self":>10}  module')
+    for i in sorted(imports, key=lambda i: i.cumulative_us,
+                    reverse=True)[:top]:
+        click.echo(f'{i.cumulative_us / 1000:9.1f} ms {i.self_us / 1000:7.1f} '
+                   f'ms  {"  " * i.depth}{i.module}')
@@ -5,6 +5,47 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'hard to guess string'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 'orjson', 'stdlib' or 'auto' to use orjson when it is installed
+    JSON_BACKEND = os.environ.get('JSON_BACKEND') or 'auto'
+    # file of the write-behind booking queue, bookings are written
+    # synchronously if it is not set
+    BOOKING_QUEUE = os.environ.get('BOOKING_QUEUE')
+    BOOKING_QUEUE_WORKERS = int(os.environ.get('BOOKING_QUEUE_WORKERS') or 2)
+    BOOKING_QUEUE_BATCH_SIZE = int(
+        os.environ.get('BOOKING_QUEUE_BATCH_SIZE') or 100)
+    # seconds after which the tickets claimed by a worker which died
+    # are processed by another worker
+    BOOKING_QUEUE_CLAIM_TIMEOUT = int(
+        os.environ.get('BOOKING_QUEUE_CLAIM_TIMEOUT') or 300)
+    # responses of write requests with an Idempotency-Key header are
+    # replayed to retries for IDEMPOTENCY_TTL seconds
+    IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL') or 24 * 60 * 60)
+    IDEMPOTENCY_MAXSIZE = int(os.environ.get('IDEMPOTENCY_MAXSIZE') or 10000)
+    # write requests per second and burst of each token subject, not
+    # limited if it is not set. the buckets are kept in the
+    # RATE_LIMIT_STORE file if it is set, otherwise by each process
+    RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND') or 0)
+    RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST') or 20)
+    RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE')
+    # run on every new SQLite connection: WAL lets readers run while a
+    # writer commits, and busy_timeout makes writers wait for the lock
+    # instead of failing with 'database is locked'
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'foreign_keys': 'ON',
+        'cache_size': -16000,
+        'mmap_size': 134217728,
+    }
+    # connection pool of server databases such as PostgreSQL
+    POSTGRES_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE') or 10),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20),
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
 
     @staticmethod
     def init_app(app):
@@ -32,6 +73,11 @@ class ProductionConfig(Config):
     def init_app(cls, app):
         Config.init_app(app)
 
+        if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres'):
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+                cls.POSTGRES_ENGINE_OPTIONS,
+                **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
 
 class HerokuConfig(ProductionConfig):
     SSL_REDIRECT = True if os.environ.get('DYNO') else False
@@ -0,0 +1,29 @@
+"""booking overlap and availability indexes
+
+Revision ID: 5d2c7a9e4b13
+Revises: 21b25f50d1f7
+Create Date: 2026-10-19 10:12:40.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2c7a9e4b13'
+down_revision = '21b25f50d1f7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_bookings_vehicle_period', 'bookings',
+                    ['vehicle_VIN', 'start_datetime', 'end_datetime'],
+                    unique=False)
+    op.create_index('ix_vehicles_automatic_seats', 'vehicles',
+                    ['automatic', 'standard_seat_number'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_vehicles_automatic_seats', table_name='vehicles')
+    op.drop_index('ix_bookings_vehicle_period', table_name='bookings')
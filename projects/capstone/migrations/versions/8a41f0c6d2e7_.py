@@ -0,0 +1,40 @@
+"""list filter indexes
+
+Revision ID: 8a41f0c6d2e7
+Revises: 5d2c7a9e4b13
+Create Date: 2026-10-19 11:03:27.904512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a41f0c6d2e7'
+down_revision = '5d2c7a9e4b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_vehicles_make_VIN', 'vehicles',
+                    ['make', 'VIN'], unique=False)
+    op.create_index('ix_vehicles_fuel_type_VIN', 'vehicles',
+                    ['fuel_type', 'VIN'], unique=False)
+    op.create_index('ix_vehicles_model_year_VIN', 'vehicles',
+                    ['model_year', 'VIN'], unique=False)
+    op.create_index('ix_clients_surname_id', 'clients',
+                    ['surname', 'id'], unique=False)
+    op.create_index('ix_bookings_client_id_id', 'bookings',
+                    ['client_id', 'id'], unique=False)
+    op.create_index('ix_bookings_start_datetime', 'bookings',
+                    ['start_datetime'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_bookings_start_datetime', table_name='bookings')
+    op.drop_index('ix_bookings_client_id_id', table_name='bookings')
+    op.drop_index('ix_clients_surname_id', table_name='clients')
+    op.drop_index('ix_vehicles_model_year_VIN', table_name='vehicles')
+    op.drop_index('ix_vehicles_fuel_type_VIN', table_name='vehicles')
+    op.drop_index('ix_vehicles_make_VIN', table_name='vehicles')
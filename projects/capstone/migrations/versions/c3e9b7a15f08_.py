@@ -0,0 +1,31 @@
+"""vehicle daily usage rollup
+
+Revision ID: c3e9b7a15f08
+Revises: 8a41f0c6d2e7
+Create Date: 2026-10-19 11:48:52.117436
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e9b7a15f08'
+down_revision = '8a41f0c6d2e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('vehicle_daily_usage',
+    sa.Column('vehicle_VIN', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('booked_seconds', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['vehicle_VIN'], ['vehicles.VIN'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('vehicle_VIN', 'day')
+    )
+    # existing bookings are added by 'flask rebuild-usage'
+
+
+def downgrade():
+    op.drop_table('vehicle_daily_usage')
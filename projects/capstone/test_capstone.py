@@ -1,10 +1,28 @@
 import os
+import sys
+import time
+import subprocess
+import tempfile
+import threading
 import unittest
+from unittest import mock
 import json
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
 from app import create_app, db
-from app.models import Vehicle, Client, Booking
+from app.models import Vehicle, Client, Booking, VehicleDailyUsage
+from app.auth.auth import token_cache
+from app.api.bookings import process_booking_tickets
+from app.auth.jwks import JWKSKeyStore
+from app.booking_queue import BookingQueue
+from app.profiling import parse_importtime, profile_imports
+from app.api.idempotency import IdempotencyStore, StoredResponse
+from app.rate_limit import (RateLimited, RateLimiter, SQLiteBackend,
+                            init_rate_limiter)
+from app.auth.permissions import PermissionSet
+from app.auth.token_cache import VerifiedTokenCache
 
 ADMIN_TOKEN = f"Bearer {os.environ['ADMIN_TOKEN']}"
 USER_TOKEN = f"Bearer {os.environ['USER_TOKEN']}"
@@ -223,6 +241,1166 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
 
 
+class BookingsCountQueryTestCase(unittest.TestCase):
+    """This class represents the test case of the statements issued by
+    the list endpoints"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count(self, conn, cursor, statement, parameters, context,
+              executemany):
+        self.statements.append(statement)
+
+    def add_rows(self, number):
+        start = datetime(2020, 1, 1)
+        offset = Client.query.count()
+        for i in range(offset, offset + number):
+            vehicle = Vehicle(make='make', model=f'model {i}')
+            client = Client(forename='forename', surname=f'surname {i}',
+                            email=f'client{i}@example.com')
+            db.session.add_all([vehicle, client])
+            db.session.flush()
+            for day in range(2):
+                db.session.add(Booking(
+                    vehicle_VIN=vehicle.VIN, client_id=client.id,
+                    start_datetime=start + timedelta(days=day),
+                    end_datetime=start + timedelta(days=day, hours=8)))
+        db.session.commit()
+
+    def statements_of(self, path):
+        self.statements = []
+        response = self.app.test_client().get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(self.statements), json.loads(response.data)
+
+    def assert_constant_statements(self, path, key):
+        self.add_rows(2)
+        few, data = self.statements_of(path)
+        self.assertEqual([r['bookings_count'] for r in data[key]], [2, 2])
+
+        self.add_rows(20)
+        many, data = self.statements_of(path)
+        self.assertEqual(len(data[key]), 22)
+        self.assertEqual(few, many)
+
+    def test_get_vehicles_statements(self):
+        self.assert_constant_statements('/api/vehicles', 'vehicles')
+
+    def test_get_clients_statements(self):
+        self.assert_constant_statements('/api/clients', 'clients')
+
+    def test_vehicle_without_bookings(self):
+        db.session.add(Vehicle(make='make', model='model'))
+        db.session.commit()
+        count, data = self.statements_of('/api/vehicles')
+
+        self.assertEqual(data['vehicles'][0]['bookings_count'], 0)
+        self.assertEqual(count, 1)
+
+
+class BookingAvailabilityTestCase(unittest.TestCase):
+    """This class represents the test case of the booking overlap checks
+    and the availability search"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        # a verified token in the cache is not verified again
+        token_cache.put('booking-token', {
+            'sub': 'test|booking', 'exp': time.time() + 60,
+            'permissions': ['post:bookings', 'patch:bookings']})
+        self.header = {'Authorization': 'Bearer booking-token'}
+
+        self.small = Vehicle(make='Fiat', model='500',
+                             standard_seat_number=4, automatic=False)
+        self.large = Vehicle(make='VW', model='Touran',
+                             standard_seat_number=7, automatic=True)
+        self.client = Client(forename='Alan', surname='Turing',
+                             email='alan.turing@mustermann.com')
+        db.session.add_all([self.small, self.large, self.client])
+        db.session.commit()
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def book(self, vin, start, end):
+        return self.app.test_client().post('/api/bookings', json={
+            'vehicle_VIN': vin,
+            'client_id': self.client.id,
+            'start_datetime': start,
+            'end_datetime': end,
+        }, headers=self.header)
+
+    def available(self, query):
+        response = self.app.test_client().get('/api/vehicles/available?' +
+                                              query)
+        self.assertEqual(response.status_code, 200)
+        return [v['VIN'] for v in json.loads(response.data)['vehicles']]
+
+    def test_overlapping_booking_is_rejected(self):
+        self.assertEqual(self.book(self.small.VIN, '2021-02-14T09:00:00',
+                                   '2021-02-14T18:00:00').status_code, 200)
+
+        response = self.book(self.small.VIN, '2021-02-14T17:00:00',
+                             '2021-02-15T09:00:00')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(json.loads(response.data)['success'])
+
+    def test_adjacent_bookings_are_accepted(self):
+        self.book(self.small.VIN, '2021-02-14T09:00:00', '2021-02-14T18:00:00')
+        response = self.book(self.small.VIN, '2021-02-14T18:00:00',
+                             '2021-02-15T09:00:00')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Booking.query.count(), 2)
+
+    def test_invalid_period_is_rejected(self):
+        self.assertEqual(self.book(self.small.VIN, '2021-02-14T18:00:00',
+                                   '2021-02-14T09:00:00').status_code, 400)
+        self.assertEqual(self.book(self.small.VIN, 'tomorrow',
+                                   '2021-02-14T09:00:00').status_code, 400)
+
+    def test_patch_into_overlap_is_rejected(self):
+        self.book(self.small.VIN, '2021-02-14T09:00:00', '2021-02-14T18:00:00')
+        self.book(self.small.VIN, '2021-02-15T09:00:00', '2021-02-15T18:00:00')
+        second = Booking.query.order_by(Booking.id.desc()).first()
+
+        response = self.app.test_client().patch(
+            f'/api/bookings/{second.id}',
+            json={'start_datetime': '2021-02-14T12:00:00'},
+            headers=self.header)
+        self.assertEqual(response.status_code, 409)
+
+        # moving a booking within its own period does not conflict
+        response = self.app.test_client().patch(
+            f'/api/bookings/{second.id}',
+            json={'start_datetime': '2021-02-15T10:00:00'},
+            headers=self.header)
+        self.assertEqual(response.status_code, 200)
+
+    def test_available_vehicles(self):
+        self.book(self.small.VIN, '2021-02-14T09:00:00', '2021-02-14T18:00:00')
+        period = 'start=2021-02-14T12:00:00&end=2021-02-14T20:00:00'
+
+        self.assertEqual(self.available(period), [self.large.VIN])
+        self.assertEqual(self.available(
+            'start=2021-02-14T18:00:00&end=2021-02-14T20:00:00'),
+            [self.small.VIN, self.large.VIN])
+        self.assertEqual(self.available(
+            'start=2021-02-15T09:00:00&end=2021-02-15T18:00:00'
+            '&seats=5&automatic=true'), [self.large.VIN])
+        self.assertEqual(self.available(
+            'start=2021-02-15T09:00:00&end=2021-02-15T18:00:00'
+            '&automatic=false'), [self.small.VIN])
+
+
+class ListingTestCase(unittest.TestCase):
+    """This class represents the test case of the paginated and filtered
+    list endpoints"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        for year in range(2010, 2020):
+            db.session.add(Vehicle(make='BMW' if year % 2 else 'Audi',
+                                   model='A4', model_year=year,
+                                   fuel_type='petrol'))
+        client = Client(forename='Alan', surname='Turing',
+                        email='alan.turing@mustermann.com')
+        db.session.add(client)
+        db.session.flush()
+        for day in range(1, 6):
+            db.session.add(Booking(
+                vehicle_VIN=day, client_id=client.id,
+                start_datetime=datetime(2021, 2, day, 9),
+                end_datetime=datetime(2021, 2, day, 18)))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, path, status=200):
+        response = self.app.test_client().get(path)
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.data)
+
+    def test_keyset_pages(self):
+        vins = []
+        data = self.get('/api/vehicles?limit=4')
+        while True:
+            self.assertLessEqual(len(data['vehicles']), 4)
+            vins += [v['VIN'] for v in data['vehicles']]
+            if data['next_cursor'] is None:
+                break
+            data = self.get(
+                f"/api/vehicles?limit=4&after={data['next_cursor']}")
+
+        self.assertEqual(vins, list(range(1, 11)))
+
+    def test_vehicle_filters(self):
+        data = self.get('/api/vehicles?make=BMW'
+                        '&model_year_min=2013&model_year_max=2017')
+
+        self.assertEqual([v['model_year'] for v in data['vehicles']],
+                         [2013, 2015, 2017])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_sparse_fieldsets(self):
+        data = self.get('/api/vehicles?fields=make,bookings_count&limit=1')
+
+        self.assertEqual(data['vehicles'],
+                         [{'VIN': 1, 'make': 'Audi', 'bookings_count': 1}])
+        self.get('/api/vehicles?fields=colour', status=400)
+
+    def test_booking_window(self):
+        data = self.get('/api/bookings?fields=id&start=2021-02-02T12:00:00'
+                        '&end=2021-02-04T10:00:00')
+
+        self.assertEqual(data['bookings'], [{'id': 2}, {'id': 3}, {'id': 4}])
+
+    def test_ndjson_stream(self):
+        response = self.app.test_client().get(
+            '/api/bookings?fields=vehicle_VIN&after=2',
+            headers={'Accept': 'application/x-ndjson'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(
+            [json.loads(line) for line in response.data.splitlines()],
+            [{'id': day, 'vehicle_VIN': day} for day in range(3, 6)])
+
+    def test_invalid_parameters(self):
+        self.get('/api/bookings?client_id=alan', status=400)
+        self.get('/api/clients?limit=0', status=400)
+        self.get('/api/clients?limit=1001', status=400)
+
+
+class UtilizationTestCase(unittest.TestCase):
+    """This class represents the test case of the daily usage rollup and
+    the utilization analytics"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.vehicles = [Vehicle(make='BMW', model=f'{i} Series')
+                         for i in range(1, 5)]
+        db.session.add_all(self.vehicles)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def book(self, vehicle, start, end):
+        booking = Booking(vehicle_VIN=vehicle.VIN, start_datetime=start,
+                          end_datetime=end)
+        booking.insert()
+        return booking
+
+    def usage(self):
+        return {(row.vehicle_VIN, row.day.isoformat()): row.booked_seconds
+                for row in VehicleDailyUsage.query}
+
+    def get(self, query):
+        response = self.app.test_client().get(
+            '/api/analytics/utilization?' + query)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['periods']
+
+    def test_rollup_follows_bookings(self):
+        vin = self.vehicles[0].VIN
+        booking = self.book(self.vehicles[0], datetime(2021, 2, 1, 18),
+                            datetime(2021, 2, 2, 6))
+        self.assertEqual(self.usage(), {(vin, '2021-02-01'): 6 * 3600,
+                                        (vin, '2021-02-02'): 6 * 3600})
+
+        booking.start_datetime = datetime(2021, 2, 2, 0)
+        booking.update()
+        self.assertEqual(self.usage(), {(vin, '2021-02-01'): 0,
+                                        (vin, '2021-02-02'): 6 * 3600})
+
+        booking.delete()
+        self.assertEqual(self.usage(), {(vin, '2021-02-01'): 0,
+                                        (vin, '2021-02-02'): 0})
+
+    def test_rebuild_matches_rollup(self):
+        self.book(self.vehicles[0], datetime(2021, 2, 1, 9),
+                  datetime(2021, 2, 3, 9))
+        self.book(self.vehicles[1], datetime(2021, 2, 2, 9),
+                  datetime(2021, 2, 2, 17))
+        usage = self.usage()
+
+        VehicleDailyUsage.rebuild()
+        self.assertEqual(self.usage(), usage)
+
+    def test_daily_utilization(self):
+        self.book(self.vehicles[0], datetime(2021, 2, 1, 0),
+                  datetime(2021, 2, 1, 12))
+        self.book(self.vehicles[1], datetime(2021, 2, 1, 6),
+                  datetime(2021, 2, 2, 6))
+        self.book(self.vehicles[0], datetime(2021, 2, 1, 12),
+                  datetime(2021, 2, 1, 18))
+
+        first, second = self.get('start=2021-02-01&end=2021-02-03')
+        self.assertEqual(first['booked_hours'], 36)
+        self.assertEqual(first['available_hours'], 4 * 24)
+        self.assertEqual(first['utilization'], 36 / 96)
+        self.assertEqual(first['peak_concurrency'], 2)
+        self.assertEqual([v['booked_hours'] for v in first['vehicles']],
+                         [18, 18])
+        self.assertEqual(second['booked_hours'], 6)
+        self.assertEqual(second['peak_concurrency'], 1)
+
+    def test_weekly_and_monthly_periods(self):
+        self.book(self.vehicles[2], datetime(2021, 1, 31, 12),
+                  datetime(2021, 2, 1, 12))
+
+        weeks = self.get('start=2021-01-27&end=2021-02-10&granularity=week')
+        self.assertEqual([(w['start'], w['end']) for w in weeks],
+                         [('2021-01-27', '2021-02-01'),
+                          ('2021-02-01', '2021-02-08'),
+                          ('2021-02-08', '2021-02-10')])
+        self.assertEqual([w['booked_hours'] for w in weeks], [12, 12, 0])
+        self.assertEqual([w['peak_concurrency'] for w in weeks], [1, 1, 0])
+
+        months = self.get('start=2021-01-01&end=2021-03-01'
+                          f'&granularity=month&vehicle_VIN='
+                          f'{self.vehicles[2].VIN}')
+        self.assertEqual([m['available_hours'] for m in months],
+                         [31 * 24, 28 * 24])
+        self.assertEqual([m['booked_hours'] for m in months], [12, 12])
+
+    def test_invalid_range(self):
+        response = self.app.test_client().get(
+            '/api/analytics/utilization?start=2021-02-01&end=2021-01-01')
+        self.assertEqual(response.status_code, 400)
+
+
+class BatchTestCase(unittest.TestCase):
+    """This class represents the test case of the batch endpoints"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        token_cache.put('batch-token', {
+            'sub': 'test|batch', 'exp': time.time() + 60,
+            'permissions': ['vehicles:*', 'post:clients']})
+        self.header = {'Authorization': 'Bearer batch-token'}
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def batch(self, path, operations, status=200):
+        response = self.app.test_client().post(
+            path, json={'operations': operations}, headers=self.header)
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.data)
+
+    def test_vehicle_batch(self):
+        data = self.batch('/api/vehicles/batch', [
+            {'op': 'create', 'make': 'BMW', 'model': f'{i} Series'}
+            for i in range(1, 251)])
+        self.assertEqual(Vehicle.query.count(), 250)
+        self.assertEqual(data['stats']['succeeded'], 250)
+        self.assertEqual(data['stats']['chunks'], 3)
+
+        data = self.batch('/api/vehicles/batch', [
+            {'op': 'update', 'VIN': 1, 'model_year': 2015},
+            {'op': 'update', 'VIN': 2, 'model_year': 'new'},
+            {'op': 'delete', 'VIN': 3},
+            {'op': 'delete', 'VIN': 999},
+            {'op': 'create', 'make': 'BMW', 'colour': 'red'},
+        ])
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['updated', 'invalid', 'deleted', 'failed',
+                          'invalid'])
+        self.assertEqual(data['results'][4]['errors'],
+                         {'colour': 'unknown field'})
+        self.assertEqual(Vehicle.query.get(1).model_year, 2015)
+        self.assertIsNone(Vehicle.query.get(3))
+
+    def test_rejected_operation_fails_alone(self):
+        data = self.batch('/api/clients/batch', [
+            {'op': 'create', 'email': 'alan.turing@mustermann.com'},
+            {'op': 'create', 'email': 'alan.turing@mustermann.com'},
+            {'op': 'create', 'email': 'alonzo.church@mustermann.com'},
+        ])
+
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['created', 'failed', 'created'])
+        self.assertEqual(Client.query.count(), 2)
+
+    def test_permissions_are_checked_once_for_the_batch(self):
+        self.batch('/api/clients/batch', [
+            {'op': 'create', 'email': 'alan.turing@mustermann.com'},
+            {'op': 'delete', 'id': 1},
+        ], status=403)
+        self.assertEqual(Client.query.count(), 0)
+
+    def test_cached_permission_set_is_used(self):
+        with mock.patch.object(PermissionSet, 'from_payload') as from_payload:
+            self.batch('/api/vehicles/batch', [
+                {'op': 'create', 'make': 'BMW', 'model': '1 Series'}])
+        from_payload.assert_not_called()
+
+    def test_malformed_batch(self):
+        self.batch('/api/vehicles/batch', [{'op': 'upsert'}], status=400)
+        self.batch('/api/vehicles/batch', [], status=400)
+
+
+class BookingQueueTestCase(unittest.TestCase):
+    """This class represents the test case of the write-behind booking
+    queue"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.queue = BookingQueue(self.path)
+        self.app.extensions['booking_queue'] = self.queue
+
+        token_cache.put('queue-token', {
+            'sub': 'test|queue', 'exp': time.time() + 60,
+            'permissions': ['post:bookings']})
+        self.header = {'Authorization': 'Bearer queue-token'}
+        self.vehicle = Vehicle(make='Fiat', model='500')
+        db.session.add(self.vehicle)
+        db.session.commit()
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def book(self, start, end, status=202):
+        response = self.app.test_client().post('/api/bookings', json={
+            'vehicle_VIN': self.vehicle.VIN,
+            'start_datetime': start,
+            'end_datetime': end,
+        }, headers=self.header)
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.data).get('ticket')
+
+    def ticket(self, ticket):
+        response = self.app.test_client().get(
+            f'/api/bookings/tickets/{ticket}', headers=self.header)
+        return response.status_code, json.loads(response.data)
+
+    def test_queued_bookings_are_processed_in_a_batch(self):
+        first = self.book('2021-02-14T09:00:00', '2021-02-14T18:00:00')
+        overlapping = self.book('2021-02-14T12:00:00', '2021-02-14T20:00:00')
+        second = self.book('2021-02-15T09:00:00', '2021-02-15T18:00:00')
+        self.assertEqual(Booking.query.count(), 0)
+        self.assertEqual(self.ticket(first)[1]['status'], 'pending')
+
+        self.assertEqual(self.queue.process(process_booking_tickets), 3)
+        self.assertEqual(self.queue.process(process_booking_tickets), 0)
+
+        self.assertEqual(Booking.query.count(), 2)
+        status, data = self.ticket(first)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['status'], 'created')
+        self.assertEqual(Booking.query.get(data['booking_id']).start_datetime,
+                         datetime(2021, 2, 14, 9))
+        self.assertEqual(self.ticket(overlapping)[1]['status'], 'conflict')
+        self.assertEqual(self.ticket(second)[1]['status'], 'created')
+
+    def test_invalid_bookings_are_not_queued(self):
+        self.book('2021-02-14T18:00:00', '2021-02-14T09:00:00', status=400)
+        self.assertEqual(self.queue.claim(), [])
+        self.assertEqual(self.ticket('unknown')[0], 404)
+
+    def test_claims_of_live_workers_are_kept(self):
+        ticket = self.book('2021-02-14T09:00:00', '2021-02-14T18:00:00')
+        self.assertEqual(len(self.queue.claim()), 1)
+
+        # another worker process starts and opens the same file
+        other = BookingQueue(self.path)
+        self.assertEqual(other.status(ticket)['status'], 'processing')
+        self.assertEqual(other.claim(), [])
+        other.release([ticket])
+
+        self.queue.complete({ticket: {'status': 'created'}})
+        self.assertEqual(other.status(ticket)['status'], 'created')
+
+    def test_expired_claims_are_claimed_again(self):
+        ticket = self.book('2021-02-14T09:00:00', '2021-02-14T18:00:00')
+        self.queue.claim()
+
+        # the worker died, its claim expires
+        other = BookingQueue(self.path, claim_timeout=0)
+        self.assertEqual([t for t, _ in other.claim()], [ticket])
+
+        # the tickets of the expired claim are no longer completed by it
+        self.queue.complete({ticket: {'status': 'conflict'}})
+        other.complete({ticket: {'status': 'created'}})
+        self.assertEqual(other.status(ticket)['status'], 'created')
+
+
+class ConcurrentWritersTestCase(unittest.TestCase):
+    """This class represents the stress test of concurrent writers on a
+    SQLite file with the configured pragmas"""
+
+    threads = 8
+    bookings_per_thread = 20
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.app = create_app("testing")
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.path}'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        token_cache.put('stress-token', {
+            'sub': 'test|stress', 'exp': time.time() + 60,
+            'permissions': ['post:bookings']})
+        db.session.add_all([Vehicle(make='Fiat', model='500')
+                            for _ in range(self.threads)])
+        db.session.commit()
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        db.get_engine().dispose()
+        self.app_context.pop()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_pragmas_are_applied(self):
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(),
+                         'wal')
+        self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(),
+                         5000)
+
+    def test_concurrent_writers(self):
+        statuses = []
+
+        def write(vin):
+            client = self.app.test_client()
+            for day in range(self.bookings_per_thread):
+                response = client.post('/api/bookings', json={
+                    'vehicle_VIN': vin,
+                    'start_datetime': f'2021-03-{day + 1:02d}T09:00:00',
+                    'end_datetime': f'2021-03-{day + 1:02d}T18:00:00',
+                }, headers={'Authorization': 'Bearer stress-token'})
+                statuses.append(response.status_code)
+
+        writers = [threading.Thread(target=write, args=(vin,))
+                   for vin in range(1, self.threads + 1)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+
+        total = self.threads * self.bookings_per_thread
+        self.assertEqual(statuses, [200] * total)
+        self.assertEqual(Booking.query.count(), total)
+
+    def test_concurrent_overlapping_bookings(self):
+        statuses = []
+        ready = threading.Barrier(self.threads)
+
+        def write(day):
+            client = self.app.test_client()
+            ready.wait()
+            for hour in range(9, 13):
+                response = client.post('/api/bookings', json={
+                    'vehicle_VIN': 1,
+                    'start_datetime': f'2021-03-01T{hour:02d}:00:00',
+                    'end_datetime': f'2021-03-0{day % 2 + 2}T09:00:00',
+                }, headers={'Authorization': 'Bearer stress-token'})
+                statuses.append(response.status_code)
+
+        writers = [threading.Thread(target=write, args=(day,))
+                   for day in range(self.threads)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+
+        self.assertEqual(sorted(statuses),
+                         [200] + [409] * (len(statuses) - 1))
+        self.assertEqual(Booking.query.count(), 1)
+        booking = Booking.query.one()
+        self.assertEqual(
+            sum(row.booked_seconds for row in VehicleDailyUsage.query),
+            (booking.end_datetime - booking.start_datetime).total_seconds())
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the test case of the cached JWKS keys"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.write_keys('key-1')
+        self.store = JWKSKeyStore(f'file://{self.path}', ttl=60,
+                                  min_refresh_interval=60)
+        self.fetches = 0
+        fetch = self.store.fetch
+
+        def counting_fetch():
+            self.fetches += 1
+            return fetch()
+        self.store.fetch = counting_fetch
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write_keys(self, *kids):
+        with open(self.path, 'w') as f:
+            json.dump({'keys': [{'kid': kid, 'kty': 'RSA', 'use': 'sig',
+                                 'n': 'n', 'e': 'AQAB'} for kid in kids]}, f)
+
+    def test_keys_are_cached(self):
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.fetches, 1)
+
+    def test_unknown_kid_refetches_rate_limited(self):
+        self.store.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+        # the document was fetched less than min_refresh_interval ago
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.assertEqual(self.fetches, 1)
+
+        self.store.min_refresh_interval = 0
+        self.assertEqual(self.store.get_key('key-2')['kid'], 'key-2')
+        self.assertEqual(self.fetches, 2)
+
+    def test_expired_keys_refresh_in_background(self):
+        self.store.get_key('key-1')
+        self.store._expires_at = time.monotonic() - 1
+        self.store.min_refresh_interval = 0
+
+        # the expired key is served while the refresh runs
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        for _ in range(100):
+            if self.fetches == 2 and not self.store._refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.fetches, 2)
+        self.assertGreater(self.store._expires_at, time.monotonic())
+
+
+    def test_failed_first_fetch_is_raised_again(self):
+        os.remove(self.path)
+        with self.assertRaises(OSError):
+            self.store.get_key('key-1')
+        # not refetched within min_refresh_interval, but still unavailable
+        with self.assertRaises(OSError):
+            self.store.get_key('key-1')
+        self.assertEqual(self.fetches, 1)
+
+        self.write_keys('key-1')
+        self.store.min_refresh_interval = 0
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+
+    def test_one_background_refresh_at_a_time(self):
+        self.store.get_key('key-1')
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch():
+            self.fetches += 1
+            started.set()
+            release.wait(5)
+            return {}, 60
+        self.store.fetch = slow_fetch
+        self.store._expires_at = time.monotonic() - 1
+
+        threads = [threading.Thread(target=self.store.get_key,
+                                    args=('key-1',)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        started.wait(5)
+        release.set()
+        self.assertEqual(self.fetches, 2)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """This class represents the test case of the verified token cache"""
+
+    def setUp(self):
+        self.cache = VerifiedTokenCache(maxsize=2)
+        self.verified = []
+
+    def verify(self, token):
+        self.verified.append(token)
+        return {'sub': token, 'exp': time.time() + 60}
+
+    def test_token_is_verified_once(self):
+        self.cache.verify('token', self.verify)
+        verified = self.cache.verify('token', self.verify)
+
+        self.assertEqual(verified.payload['sub'], 'token')
+        self.assertEqual(self.verified, ['token'])
+        self.assertEqual(self.cache.stats()['hit_rate'], 0.5)
+
+    def test_expired_token_is_verified_again(self):
+        self.cache.put('token', {'sub': 'token', 'exp': time.time() - 1})
+        self.cache.verify('token', self.verify)
+
+        self.assertEqual(self.verified, ['token'])
+
+    def test_least_recently_used_token_is_evicted(self):
+        for token in ('a', 'b', 'a', 'c', 'a', 'b'):
+            self.cache.verify(token, self.verify)
+
+        self.assertEqual(self.verified, ['a', 'b', 'c', 'b'])
+
+
+class PermissionSetTestCase(unittest.TestCase):
+    """This class represents the test case of the token permission sets"""
+
+    def test_exact_permission(self):
+        permissions = PermissionSet(['get:vehicles', 'post:vehicles'])
+
+        self.assertTrue(permissions.allows('post:vehicles'))
+        self.assertFalse(permissions.allows('delete:vehicles'))
+
+    def test_wildcard_scopes(self):
+        self.assertTrue(PermissionSet(['*:vehicles']).allows('patch:vehicles'))
+        self.assertTrue(PermissionSet(['patch:*']).allows('patch:clients'))
+        self.assertTrue(PermissionSet(['vehicles:*']).allows('post:vehicles'))
+        self.assertTrue(PermissionSet(['*']).allows('delete:bookings'))
+        self.assertFalse(PermissionSet(['*:clients']).allows('post:vehicles'))
+
+    def test_hierarchical_scopes(self):
+        permissions = PermissionSet(['patch:bookings:*'])
+
+        self.assertTrue(permissions.allows('patch:bookings:dates'))
+        self.assertFalse(permissions.allows('patch:bookings'))
+
+    def test_missing_permissions(self):
+        permissions = PermissionSet(['get:vehicles', '*:clients'])
+
+        self.assertEqual(permissions.missing(
+            ['get:vehicles', 'post:clients', 'post:bookings']),
+            ['post:bookings'])
+
+
+class StartupTestCase(unittest.TestCase):
+    """This class tests the startup of the app factory in a new interpreter"""
+    # generous, the app factory takes about 0.4s
+    startup_budget_seconds = 3.0
+
+    def setUp(self):
+        self.cwd = os.path.dirname(os.path.abspath(__file__))
+
+    def test_lazy_imports(self):
+        modules = profile_imports(
+            "from app import create_app; create_app('testing')", self.cwd)
+        imported = {module.module for module in modules}
+
+        for lazy in ('jose', 'flask_migrate', 'alembic'):
+            self.assertNotIn(lazy, imported)
+
+    def test_startup_time(self):
+        result = subprocess.run([sys.executable, '-c', (
+            'import time; started = time.perf_counter(); '
+            'from app import create_app; create_app("testing"); '
+            'print(time.perf_counter() - started)')],
+            cwd=self.cwd, stdout=subprocess.PIPE, check=True)
+        seconds = float(result.stdout)
+
+        self.assertLess(seconds, self.startup_budget_seconds)
+
+    def test_parse_importtime(self):
+        report = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       120 |        120 |   _json\n'
+            'import time:       300 |        420 | json\n')
+
+        self.assertEqual(parse_importtime(report), [
+            ('_json', 120, 120, 1), ('json', 300, 420, 0)])
+
+
+class IdempotencyTestCase(unittest.TestCase):
+    """This class represents the test case of the Idempotency-Key header"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        token_cache.put('writer-token', {
+            'sub': 'test|writer', 'exp': time.time() + 60,
+            'permissions': ['vehicles:*']})
+        token_cache.put('other-token', {
+            'sub': 'test|other', 'exp': time.time() + 60,
+            'permissions': ['vehicles:*']})
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post_vehicle(self, body, key, token='writer-token'):
+        return self.app.test_client().post(
+            '/api/vehicles', json=body, headers={
+                'Authorization': f'Bearer {token}', 'Idempotency-Key': key})
+
+    def test_retry_replays_the_response(self):
+        body = {'make': 'BMW', 'model': '530 Sedan'}
+        first = self.post_vehicle(body, 'key-1')
+        retry = self.post_vehicle(body, 'key-1')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Vehicle.query.count(), 1)
+
+    def test_keys_are_per_subject(self):
+        body = {'make': 'BMW', 'model': '530 Sedan'}
+        self.post_vehicle(body, 'key-1')
+        response = self.post_vehicle(body, 'key-1', token='other-token')
+
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(Vehicle.query.count(), 2)
+
+    def test_key_reused_for_another_request(self):
+        self.post_vehicle({'make': 'BMW', 'model': '530 Sedan'}, 'key-1')
+        response = self.post_vehicle({'make': 'BMW', 'model': 'X5'}, 'key-1')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Vehicle.query.count(), 1)
+
+    def test_retry_waits_for_the_request_in_flight(self):
+        store = IdempotencyStore()
+        self.assertIsNone(store.begin('key'))
+        results = []
+        retry = threading.Thread(
+            target=lambda: results.append(store.begin('key')))
+        retry.start()
+        time.sleep(0.05)
+        self.assertEqual(results, [])
+
+        stored = StoredResponse('fingerprint', 200, [], b'{}')
+        store.finish('key', stored)
+        retry.join()
+        self.assertEqual(results, [stored])
+
+    def test_failed_request_is_not_kept(self):
+        store = IdempotencyStore()
+        self.assertIsNone(store.begin('key'))
+        store.finish('key')
+
+        self.assertIsNone(store.begin('key'))
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """This class represents the test case of the rate limiter"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app.config.update(RATE_LIMIT_PER_SECOND=0.5, RATE_LIMIT_BURST=2)
+        init_rate_limiter(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        token_cache.put('writer-token', {
+            'sub': 'test|writer', 'exp': time.time() + 60,
+            'permissions': ['vehicles:*']})
+        token_cache.put('other-token', {
+            'sub': 'test|other', 'exp': time.time() + 60,
+            'permissions': ['vehicles:*']})
+
+    def tearDown(self):
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post_vehicle(self, token='writer-token'):
+        return self.app.test_client().post(
+            '/api/vehicles', json={'make': 'BMW', 'model': '530 Sedan'},
+            headers={'Authorization': f'Bearer {token}'})
+
+    def test_burst_then_too_many_requests(self):
+        self.assertEqual(self.post_vehicle().status_code, 200)
+        self.assertEqual(self.post_vehicle().status_code, 200)
+        response = self.post_vehicle()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertEqual(self.post_vehicle('other-token').status_code, 200)
+        self.assertEqual(Vehicle.query.count(), 3)
+
+    def test_reads_are_not_limited(self):
+        for _ in range(5):
+            self.assertEqual(
+                self.app.test_client().get('/api/vehicles').status_code, 200)
+
+    def test_sqlite_backend_is_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'buckets.sqlite')
+            first = RateLimiter(0.5, 1, SQLiteBackend(path))
+            second = RateLimiter(0.5, 1, SQLiteBackend(path))
+
+            first.check('test|writer')
+            with self.assertRaises(RateLimited):
+                second.check('test|writer')
+            second.check('test|other')
+
+
+class ClientLookupTestCase(unittest.TestCase):
+    """This class represents the test case of the client lookup by email"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Client.email_cache.clear()
+        for name in ('alan.turing', 'alonzo.church', 'kurt.goedel'):
+            forename, surname = name.split('.')
+            db.session.add(Client(forename=forename, surname=surname,
+                                  email=f'{name}@mustermann.com'))
+        db.session.commit()
+
+        token_cache.put('clients-token', {
+            'sub': 'test|clients', 'exp': time.time() + 60,
+            'permissions': ['clients:*']})
+        self.header = {'Authorization': 'Bearer clients-token'}
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        token_cache.clear()
+        Client.email_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count(self, conn, cursor, statement, parameters, context,
+              executemany):
+        self.statements.append(statement)
+
+    def lookup(self, emails):
+        response = self.app.test_client().post('/api/clients/lookup',
+                                               json={'emails': emails})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_get_client_by_email(self):
+        response = self.app.test_client().get(
+            '/api/clients?email=alonzo.church@mustermann.com&fields=surname')
+        data = json.loads(response.data)
+
+        self.assertEqual(data['clients'], [{'id': 2, 'surname': 'church'}])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_lookup_is_a_single_in_query(self):
+        data = self.lookup(['kurt.goedel@mustermann.com',
+                            'alan.turing@mustermann.com',
+                            'emmy.noether@mustermann.com'])
+
+        self.assertEqual([c['id'] for c in data['clients']], [3, 1])
+        self.assertEqual(data['missing'], ['emmy.noether@mustermann.com'])
+        self.assertEqual(len(self.statements), 1)
+        self.assertIn(' IN ', self.statements[0])
+
+    def test_repeated_lookups_are_cached(self):
+        emails = ['alan.turing@mustermann.com', 'emmy.noether@mustermann.com']
+        first = self.lookup(emails)
+        second = self.lookup(emails)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.statements), 1)
+
+    def test_writes_invalidate_the_cache(self):
+        self.lookup(['alan.turing@mustermann.com',
+                     'emmy.noether@mustermann.com'])
+        self.app.test_client().patch('/api/clients/1', headers=self.header,
+                                     json={'email': 'a.turing@mustermann.com'})
+        self.app.test_client().post('/api/clients/batch', headers=self.header,
+                                    json={'operations': [{
+                                        'op': 'create', 'forename': 'emmy',
+                                        'email': 'emmy.noether@mustermann.com'
+                                    }]})
+
+        data = self.lookup(['alan.turing@mustermann.com',
+                            'a.turing@mustermann.com',
+                            'emmy.noether@mustermann.com'])
+        self.assertEqual([c['id'] for c in data['clients']], [1, 4])
+        self.assertEqual(data['missing'], ['alan.turing@mustermann.com'])
+
+    def test_malformed_lookup(self):
+        for body in ({}, {'emails': []}, {'emails': [1]},
+                     {'emails': ['a@b.c'] * 501}):
+            response = self.app.test_client().post('/api/clients/lookup',
+                                                   json=body)
+            self.assertEqual(response.status_code, 400)
+
+
+class PartialUpdateTestCase(unittest.TestCase):
+    """This class represents the test case of the PATCH endpoints"""
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add_all([Vehicle(make='BMW', model='530 Sedan'),
+                            Vehicle(make='Audi', model='A4'),
+                            Client(forename='Alan', surname='Turing')])
+        db.session.commit()
+        for start, end in (('2021-03-01T09:00:00', '2021-03-02T09:00:00'),
+                           ('2021-03-03T09:00:00', '2021-03-04T09:00:00')):
+            Booking(vehicle_VIN=1, client_id=1,
+                    start_datetime=datetime.fromisoformat(start),
+                    end_datetime=datetime.fromisoformat(end)).insert()
+
+        token_cache.put('patch-token', {
+            'sub': 'test|patch', 'exp': time.time() + 60,
+            'permissions': ['patch:*']})
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        token_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count(self, conn, cursor, statement, parameters, context,
+              executemany):
+        self.statements.append(statement.split()[0])
+
+    def patch(self, path, body, status=200):
+        response = self.app.test_client().patch(
+            path, json=body, headers={'Authorization': 'Bearer patch-token'})
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.data)
+
+    def test_patch_vehicle_without_loading_it(self):
+        data = self.patch('/api/vehicles/1', {'make': 'Mini',
+                                              'fuel_type': 'petrol'})
+
+        self.assertEqual(data['vehicles'][0]['make'], 'Mini')
+        self.assertEqual(data['vehicles'][0]['fuel_type'], 'petrol')
+        self.assertEqual(data['vehicles'][0]['bookings_count'], 2)
+        self.assertEqual(self.statements, ['UPDATE', 'SELECT'])
+        self.assertEqual(data['vehicles'][0], json.loads(
+            self.app.test_client().get('/api/vehicles/1').data)['vehicles'][0])
+        db.session.expire_all()
+        self.assertEqual(Vehicle.query.get(1).make, 'Mini')
+
+    def test_patch_validates_the_fields(self):
+        self.patch('/api/vehicles/1', {'VIN': 2}, status=400)
+        self.patch('/api/vehicles/1', {'model_year': '2010'}, status=400)
+        self.patch('/api/vehicles/1', {}, status=400)
+        self.patch('/api/vehicles/9', {'model': 'X5'}, status=404)
+
+    def test_patch_client(self):
+        data = self.patch('/api/clients/1', {'surname': 'Mathison'})
+
+        self.assertEqual(data['clients'][0]['surname'], 'Mathison')
+        self.patch('/api/clients/1', {'surname': 1912}, status=400)
+
+    def test_patch_booking_moves_the_rollup(self):
+        data = self.patch('/api/bookings/2', {
+            'vehicle_VIN': 2, 'end_datetime': '2021-03-03T21:00:00'})
+
+        self.assertEqual(data['bookings'][0]['vehicle_VIN'], 2)
+        self.assertEqual(
+            {(row.vehicle_VIN, row.day.isoformat()): row.booked_seconds
+             for row in VehicleDailyUsage.query
+             if row.booked_seconds},
+            {(1, '2021-03-01'): 15 * 3600, (1, '2021-03-02'): 9 * 3600,
+             (2, '2021-03-03'): 12 * 3600})
+
+    def test_single_rows_have_iso_dates(self):
+        single = json.loads(self.app.test_client().get(
+            '/api/bookings/2').data)['bookings'][0]
+        listed = json.loads(self.app.test_client().get(
+            '/api/bookings').data)['bookings'][1]
+
+        self.assertEqual(single['start_datetime'], '2021-03-03T09:00:00')
+        self.assertEqual(single['start_datetime'], listed['start_datetime'])
+
+    def test_patch_booking_overlap(self):
+        self.patch('/api/bookings/2', {'start_datetime': '2021-03-01T21:00:00'},
+                   status=409)
+        self.patch('/api/bookings/2', {'end_datetime': '2021-03-02T09:00:00'},
+                   status=400)
+        self.patch('/api/bookings/9', {'client_id': 1}, status=404)
+
+        db.session.expire_all()
+        self.assertEqual(Booking.query.get(2).start_datetime,
+                         datetime(2021, 3, 3, 9))
+
+    def test_patch_booking_unknown_client(self):
+        rollup = {(row.vehicle_VIN, row.day): row.booked_seconds
+                  for row in VehicleDailyUsage.query}
+
+        self.patch('/api/bookings/1', {'client_id': 99}, status=422)
+        self.patch('/api/bookings/1', {'client_id': 99, 'vehicle_VIN': 2},
+                   status=422)
+
+        db.session.expire_all()
+        self.assertEqual(Booking.query.get(1).client_id, 1)
+        self.assertEqual(Booking.query.get(1).vehicle_VIN, 1)
+        self.assertEqual({(row.vehicle_VIN, row.day): row.booked_seconds
+                          for row in VehicleDailyUsage.query}, rollup)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()